@@ -2,6 +2,9 @@ import argparse
 from pathlib import Path
 
 import pose_detector.generation.generator as generator
+import pose_detector.generation.farm as farm
+import pose_detector.generation.presets as presets
+import pose_detector.training.precision as precision
 import pose_detector.training.training as training
 import pose_detector.benchmark.benchmark as benchmark
 import pose_detector.serving.serving as serving
@@ -39,25 +42,192 @@ def main():
     datagen_parser.add_argument("--mode", type=str, default="all", choices=["all", "render", "process"],
                                 help="Only perform one step of the generation")
     datagen_parser.add_argument("--size", "-s", type=int, default=10,
-                                help="The target size of the dataset to be generated, this might vary by a few images "
-                                     "depending on the number of models and parallelization")
+                                help="The size of the dataset to be generated")
     datagen_parser.add_argument("--parallel", "-p", type=int, default=1,
-                                help="How many process to use in parallel for rending the images")
+                                help="How many process to use in parallel for rendering and processing the images")
+    datagen_parser.add_argument("--background-weights", type=Path, default=None,
+                                help="Path to a .yaml file mapping background file names to how likely they are used, "
+                                     "backgrounds that are not listed get a weight of 1")
+    datagen_parser.add_argument("--background-memory", type=int, default=4096,
+                                help="How many MB the decoded backgrounds may take up, if they need more they are "
+                                     "decoded on demand")
+    datagen_parser.add_argument("--background-mode", type=str, default="crop", choices=["crop", "pyramid", "pool"],
+                                help="How the background crops are created: 'crop' resizes a crop of the full "
+                                     "resolution background, 'pyramid' crops pre-downscaled versions of the "
+                                     "backgrounds, 'pool' draws from a pool of crops that is created in advance")
+    datagen_parser.add_argument("--crop-pool-size", type=int, default=10000,
+                                help="How many background crops are created in advance in the 'pool' mode")
+    datagen_parser.add_argument("--stream", action="store_true",
+                                help="Process the images while they are being rendered instead of afterwards, only "
+                                     "used in the 'all' mode")
+    datagen_parser.add_argument("--output-format", type=str, default="png", choices=["png", "tfrecord", "raw"],
+                                help="Store each image as a separate .png file, store the images in TFRecord shards "
+                                     "or store the raw pixels of all images in a single file that can be "
+                                     "memory-mapped")
+    datagen_parser.add_argument("--shard-size", type=int, default=1000,
+                                help="How many images are stored in a single TFRecord shard")
+    datagen_parser.add_argument("--fresh-processes", action="store_true",
+                                help="Start a new Blender process for every chunk of images instead of keeping the "
+                                     "processes running, this is slower but isolates the chunks from each other")
+    datagen_parser.add_argument("--render-retries", type=int, default=2,
+                                help="How often the images of a failed chunk are rendered again before giving up")
+    datagen_parser.add_argument("--seed", type=int, default=None,
+                                help="Seed for rendering and processing the images, every chunk of images and every "
+                                     "processed image gets its own seed derived from it")
+    datagen_parser.add_argument("--devices", type=str, default=None,
+                                help="Comma separated GPU indices or 'cpu', the parallel processes are distributed "
+                                     "evenly over these devices, by default every process uses all GPUs")
+    datagen_parser.add_argument("--cpu-threads", type=int, default=None,
+                                help="How many threads each process rendering on the CPU uses, by default the cores "
+                                     "are shared evenly")
+    datagen_parser.add_argument("--farm", type=str, default=None, metavar="ADDRESS",
+                                help="Render the images on render nodes started with 'render-node' instead of "
+                                     "locally, the nodes connect to this address given as host:port")
+    datagen_parser.add_argument("--farm-key", type=str, default=None,
+                                help="The key the render nodes have to authenticate with, required for --farm")
+    datagen_parser.add_argument("--preset", type=str, default=None, choices=list(presets.PRESETS),
+                                help="Replace the render settings of the RgbRenderer in the config with the ones of "
+                                     "a preset, 'draft' is the fastest, 'hq' the most accurate Cycles preset, 'eevee' "
+                                     "and 'workbench' render with a rasterizing engine instead of Cycles")
+    datagen_parser.add_argument("--keep-alpha", action="store_true",
+                                help="Store the rendered images with their alpha channel instead of adding "
+                                     "backgrounds, flips and rotations, they are added during the training with "
+                                     "'train --augment --backgrounds'")
     datagen_parser.set_defaults(func=generator.generate_dataset)
 
+    render_benchmark_parser = subparsers.add_parser("benchmark-render",
+                                                    help="Find how many rendering processes per device render the "
+                                                         "fastest",
+                                                    description="Find how many rendering processes per device render "
+                                                                "the fastest by rendering the same number of images "
+                                                                "with an increasing number of processes per device.")
+    render_benchmark_parser.add_argument("config_path", type=Path, metavar="config",
+                                         help="Path to the configuration file for BlenderProc")
+    render_benchmark_parser.add_argument("models_path", type=Path, metavar="models",
+                                         help="Path to the directory containing the models as individual .blend files")
+    render_benchmark_parser.add_argument("output_path", type=Path, metavar="output",
+                                         help="Path to the directory where the images are stored temporarily")
+    render_benchmark_parser.add_argument("--devices", type=str, default=None,
+                                         help="Comma separated GPU indices or 'cpu', by default every process uses "
+                                              "all GPUs")
+    render_benchmark_parser.add_argument("--max-workers", type=int, default=4,
+                                         help="The largest number of processes per device that is tried")
+    render_benchmark_parser.add_argument("--size", "-s", type=int, default=100,
+                                         help="How many images are rendered per device for each number of processes")
+    render_benchmark_parser.add_argument("--cpu-threads", type=int, default=None,
+                                         help="How many threads each process rendering on the CPU uses, by default "
+                                              "the cores are shared evenly")
+    render_benchmark_parser.set_defaults(func=generator.benchmark_rendering)
+
+    render_node_parser = subparsers.add_parser("render-node",
+                                               help="Render images for a 'generate' command running with --farm",
+                                               description="Render images for a 'generate' command running with "
+                                                           "--farm. The node connects to the coordinator, renders "
+                                                           "the chunks of images it is handed out and sends the "
+                                                           "rendered images back. It stops once all images are "
+                                                           "rendered.")
+    render_node_parser.add_argument("address", type=str,
+                                    help="The address of the coordinator given as host:port")
+    render_node_parser.add_argument("config_path", type=Path, metavar="config",
+                                    help="Path to the configuration file for BlenderProc")
+    render_node_parser.add_argument("models_path", type=Path, metavar="models",
+                                    help="Path to the directory containing the same models as the coordinator")
+    render_node_parser.add_argument("--farm-key", type=str, required=True,
+                                    help="The key to authenticate with at the coordinator")
+    render_node_parser.add_argument("--parallel", "-p", type=int, default=1,
+                                    help="How many chunks to render in parallel")
+    render_node_parser.add_argument("--devices", type=str, default=None,
+                                    help="Comma separated GPU indices or 'cpu', by default every process uses all "
+                                         "GPUs")
+    render_node_parser.add_argument("--cpu-threads", type=int, default=None,
+                                    help="How many threads each process rendering on the CPU uses, by default the "
+                                         "cores are shared evenly")
+    render_node_parser.add_argument("--preset", type=str, default=None, choices=list(presets.PRESETS),
+                                    help="The render preset, must be the same as the one of the coordinator")
+    render_node_parser.set_defaults(func=farm.run_node)
+
+    calibrate_parser = subparsers.add_parser("calibrate-presets",
+                                             help="Compare the render time and image quality of the render presets",
+                                             description="Compare the render time and image quality of the render "
+                                                         "presets. The same images are rendered with every preset, "
+                                                         "then the seconds per frame and the difference to the "
+                                                         "images of the 'hq' preset are reported.")
+    calibrate_parser.add_argument("config_path", type=Path, metavar="config",
+                                  help="Path to the configuration file for BlenderProc")
+    calibrate_parser.add_argument("models_path", type=Path, metavar="models",
+                                  help="Path to the directory containing the models as individual .blend files")
+    calibrate_parser.add_argument("output_path", type=Path, metavar="output",
+                                  help="Path to the directory where the images are stored temporarily")
+    calibrate_parser.add_argument("--size", "-s", type=int, default=10,
+                                  help="How many images of each model are rendered per preset")
+    calibrate_parser.add_argument("--seed", type=int, default=0,
+                                  help="Seed used for rendering the images")
+    calibrate_parser.add_argument("--devices", type=str, default=None,
+                                  help="The GPU index or 'cpu' to render on, by default all GPUs are used")
+    calibrate_parser.add_argument("--cpu-threads", type=int, default=None,
+                                  help="How many threads are used when rendering on the CPU, by default all cores")
+    calibrate_parser.set_defaults(func=presets.calibrate_presets)
+
     train_parser = subparsers.add_parser("train",
                                          help="Train a CNN using a previously created dataset.",
                                          description="""Train a CNN using a previously created dataset.
                                                                                   
                                          This uses transfer learning on the `resnet18` model pretrained on the 
                                          `imagenet` dataset. It tries to predict the value encoded in the image name 
-                                         created by the generation step. It will train for 20 epochs and then save 
-                                         the generated model.
+                                         created by the generation step. It will train for 20 epochs by default 
+                                         and then save the generated model.
                                          """)
     train_parser.add_argument("images_directory", type=Path, metavar="dataset",
                               help="Path to the directory where the dataset is stored")
     train_parser.add_argument("save_path", type=Path, metavar="output",
                               help="Path where the trained model should be saved to")
+    train_parser.add_argument("--targets", type=str, default=None,
+                              help="Comma separated names of labels from the label sidecar of the dataset to predict "
+                                   "instead of the value encoded in the image names, e.g. 'open,wrist,rot'. The "
+                                   "model predicts all of them at once with an output for each")
+    train_parser.add_argument("--loss-weights", type=str, default=None,
+                              help="Comma separated weights of the losses of the targets, e.g. 'open=2,rot=0.5', "
+                                   "targets that are not listed get a weight of 1")
+    train_parser.add_argument("--val-fraction", type=float, default=0.2,
+                              help="Fraction of the dataset used for validation. Images are assigned to the splits by "
+                                   "a hash of their number, so the split is the same in every run")
+    train_parser.add_argument("--test-fraction", type=float, default=0.0,
+                              help="Fraction of the dataset held out for testing, it is only evaluated once after "
+                                   "the training")
+    train_parser.add_argument("--cache-dir", type=Path, default=None,
+                              help="Directory where the decoded images are cached instead of keeping them in memory. "
+                                   "The cache is reused by later runs as long as the dataset does not change")
+    train_parser.add_argument("--augment", action="store_true",
+                              help="Randomly flip and rotate the training images in every epoch, the images are "
+                                   "only flipped and rotated without --targets")
+    train_parser.add_argument("--backgrounds", type=Path, default=None, dest="backgrounds_path",
+                              metavar="BACKGROUNDS",
+                              help="Path of a directory containing background images, the images of a dataset "
+                                   "generated with --keep-alpha are put on top of random crops of them, requires "
+                                   "--augment")
+    train_parser.add_argument("--precision", type=str, default="float32", choices=precision.PRECISIONS,
+                              help="Compute in float32 or use mixed precision, 'mixed' uses float16 on GPUs and "
+                                   "bfloat16 on CPUs that support it and falls back to float32 otherwise")
+    train_parser.add_argument("--jit-compile", action="store_true",
+                              help="Compile the training step with XLA")
+    train_parser.add_argument("--config", type=Path, default=None, dest="config_path", metavar="CONFIG",
+                              help="Path to a .yaml file containing the hyperparameters epochs, batch_size, "
+                                   "shuffle_buffer, learning_rate and autotune_batch_size, flags take precedence "
+                                   "over it")
+    train_parser.add_argument("--epochs", type=int, default=None,
+                              help="How many epochs to train for, 20 by default")
+    train_parser.add_argument("--batch-size", type=int, default=None,
+                              help="How many images are in a batch, 64 by default")
+    train_parser.add_argument("--shuffle-buffer", type=int, default=None,
+                              help="How many images the training dataset is shuffled across, 1000 by default")
+    train_parser.add_argument("--learning-rate", type=float, default=None,
+                              help="The learning rate of the optimizer, 0.0001 by default")
+    train_parser.add_argument("--autotune-batch-size", action="store_true", default=None,
+                              help="Search the batch size with the highest throughput before the training and scale "
+                                   "the learning rate linearly with it")
+    train_parser.add_argument("--no-autotune-batch-size", action="store_false", default=None,
+                              dest="autotune_batch_size",
+                              help="Use the batch size as given, even if the config enables autotune_batch_size")
     train_parser.set_defaults(func=training.run)
 
     benchmark_parser = subparsers.add_parser("benchmark",
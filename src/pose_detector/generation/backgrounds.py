@@ -0,0 +1,353 @@
+import os
+import random
+import tempfile
+from collections import OrderedDict
+from math import log2
+
+import cv2
+import numpy as np
+import yaml
+
+# By default the decoded backgrounds may take up this many bytes
+DEFAULT_MAX_MEMORY = 4096 * 1024 * 1024
+
+# Width and height of the background crops
+CROP_SIZE = 128
+
+# How background crops are created:
+#   "crop": Crop the full resolution background and resize it
+#   "pyramid": Crop the nearest pre-downscaled level of the background and resize it
+#   "pool": Draw from a pool of crops created in advance
+MODES = ["crop", "pyramid", "pool"]
+
+
+class BackgroundBank:
+    """A collection of decoded background images that can be shared between processes.
+
+    All backgrounds are decoded once and stored in a single memory-mapped file, so worker
+    processes can read them without decoding any image again. The operating system shares
+    the mapped pages between all processes. If the decoded backgrounds would take up more
+    than max_memory bytes, a bounded LRU cache of decoded images is used in each process
+    instead.
+
+    In the "pyramid" mode each background is stored along with versions of it that are
+    repeatedly downscaled by a factor of two. In the "pool" mode pool_size crops are
+    created in advance and stored in their own memory-mapped file.
+
+    Attributes:
+        paths: The paths of the background images.
+        weights: How likely each background is to be sampled, None for uniform sampling.
+        max_memory: Maximum number of bytes the decoded backgrounds may take up.
+        mode: How background crops are created, one of MODES.
+        pool_size: How many crops are created in advance in the "pool" mode.
+        file_path: Location of the memory-mapped file, None if the LRU cache is used.
+        pool_path: Location of the memory-mapped file containing the crop pool.
+        shapes: The shape of each image stored in the memory-mapped file.
+        offsets: The byte offset of each image stored in the memory-mapped file.
+        levels: The indices of the stored images belonging to each background, ordered by
+          decreasing resolution.
+    """
+
+    def __init__(self, paths, weights=None, max_memory=DEFAULT_MAX_MEMORY, mode="crop", pool_size=10000):
+        if mode not in MODES:
+            raise ValueError("Unknown background mode {}".format(mode))
+
+        self.paths = list(paths)
+        self.weights = weights
+        self.max_memory = max_memory
+        self.mode = mode
+        self.pool_size = pool_size
+        self.file_path = None
+        self.pool_path = None
+        self.shapes = []
+        self.offsets = []
+        self.levels = []
+
+        self._data = None
+        self._pool = None
+        self._cache = OrderedDict()
+        self._cache_size = 0
+
+    def build(self):
+        """Decodes all backgrounds into the memory-mapped file.
+
+        Falls back to the LRU cache if the decoded backgrounds do not fit into max_memory.
+        In the "pool" mode the crop pool is created afterwards and the decoded backgrounds
+        are discarded.
+        """
+
+        fd, file_path = tempfile.mkstemp(prefix="backgrounds_", suffix=".bank")
+        size = 0
+
+        with os.fdopen(fd, "wb") as f:
+            for path in self.paths:
+                levels = self._read(path)
+                level_size = sum(level.nbytes for level in levels)
+                if size + level_size > self.max_memory:
+                    break
+
+                self.levels.append(list(range(len(self.shapes), len(self.shapes) + len(levels))))
+                for level in levels:
+                    self.shapes.append(level.shape)
+                    self.offsets.append(size)
+                    f.write(level.tobytes())
+                    size += level.nbytes
+
+        if len(self.levels) < len(self.paths):
+            print("Backgrounds exceed {} bytes, decoding them on demand".format(self.max_memory))
+            os.remove(file_path)
+            self.shapes = []
+            self.offsets = []
+            self.levels = []
+        else:
+            print("Decoded {} backgrounds ({} bytes)".format(len(self.paths), size))
+            self.file_path = file_path
+
+        if self.mode == "pool":
+            self._build_pool()
+
+    def close(self):
+        """Removes the memory-mapped files.
+        """
+
+        self._data = None
+        self._pool = None
+        for path in [self.file_path, self.pool_path]:
+            if path is not None:
+                os.remove(path)
+
+        self.file_path = None
+        self.pool_path = None
+
+    def sample(self):
+        """Samples a background image.
+
+        Returns: A decoded background image, it must not be modified.
+        """
+
+        return self.get_levels(self._sample_index())[0]
+
+    def sample_crop(self):
+        """Samples a random crop of a background image.
+
+        Returns: A CROP_SIZE x CROP_SIZE image, it must not be modified.
+        """
+
+        if self.mode == "pool":
+            if self._pool is None:
+                self._pool = np.memmap(self.pool_path, dtype=np.uint8, mode="r",
+                                       shape=(self.pool_size, CROP_SIZE, CROP_SIZE, 3))
+
+            return self._pool[random.randrange(self.pool_size)]
+
+        levels = self.get_levels(self._sample_index())
+        if self.mode == "pyramid":
+            return _get_random_pyramid_crop(levels)
+
+        return _get_random_background_crop(levels[0])
+
+    def get_levels(self, index):
+        """Returns the decoded background image at an index and its downscaled versions.
+
+        The images must not be modified.
+        """
+
+        if self.file_path is None:
+            return self._get_cached(index)
+
+        if self._data is None:
+            self._data = np.memmap(self.file_path, dtype=np.uint8, mode="r")
+
+        levels = []
+        for entry in self.levels[index]:
+            shape = self.shapes[entry]
+            offset = self.offsets[entry]
+            levels.append(self._data[offset:offset + int(np.prod(shape))].reshape(shape))
+
+        return levels
+
+    def _sample_index(self):
+        """Samples the index of a background according to the weights.
+        """
+
+        return random.choices(range(len(self.paths)), weights=self.weights)[0]
+
+    def _build_pool(self):
+        """Creates the crop pool from the decoded backgrounds.
+        """
+
+        fd, self.pool_path = tempfile.mkstemp(prefix="background_crops_", suffix=".bank")
+        os.close(fd)
+
+        pool = np.memmap(self.pool_path, dtype=np.uint8, mode="w+", shape=(self.pool_size, CROP_SIZE, CROP_SIZE, 3))
+        for i in range(self.pool_size):
+            pool[i] = _get_random_pyramid_crop(self.get_levels(self._sample_index()))
+        pool.flush()
+        del pool
+
+        # the decoded backgrounds are not needed anymore
+        self._data = None
+        self._cache = OrderedDict()
+        self._cache_size = 0
+        if self.file_path is not None:
+            os.remove(self.file_path)
+            self.file_path = None
+
+        print("Created a pool of {} background crops".format(self.pool_size))
+
+    def _get_cached(self, index):
+        """Returns a decoded background image and its downscaled versions from the LRU cache.
+        """
+
+        if index in self._cache:
+            self._cache.move_to_end(index)
+            return self._cache[index]
+
+        levels = self._read(self.paths[index])
+        self._cache[index] = levels
+        self._cache_size += sum(level.nbytes for level in levels)
+
+        # always keep the most recent image, even if it alone exceeds the limit
+        while self._cache_size > self.max_memory and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_size -= sum(level.nbytes for level in evicted)
+
+        return levels
+
+    def _read(self, path):
+        """Reads a background image and creates the downscaled versions required by the mode.
+        """
+
+        img = cv2.imread(str(path))
+        if img is None:
+            raise ValueError("Could not read background image {}".format(path))
+
+        if self.mode == "crop":
+            return [img]
+
+        return _create_pyramid(img)
+
+    def __getstate__(self):
+        # only the description of the bank is sent to other processes, each of them
+        # maps the files or fills its cache on its own
+        state = self.__dict__.copy()
+        state["_data"] = None
+        state["_pool"] = None
+        state["_cache"] = OrderedDict()
+        state["_cache_size"] = 0
+        return state
+
+
+def load_weights(weights_path, backgrounds):
+    """Loads the sampling weights of the backgrounds.
+
+    The file must contain a mapping of background file names to weights. Backgrounds
+    that are not listed get a weight of 1.
+
+    Args:
+        weights_path: Path of the .yaml file containing the weights, if None all
+          backgrounds are sampled uniformly.
+        backgrounds: List of paths of the background images.
+
+    Returns:
+        A list of weights in the order of backgrounds or None.
+    """
+
+    if weights_path is None:
+        return None
+
+    with open(weights_path) as f:
+        weights = yaml.safe_load(f) or {}
+
+    return [float(weights.get(path.name, 1)) for path in backgrounds]
+
+
+def _create_pyramid(img):
+    """Repeatedly downscales an image by a factor of two.
+
+    Only creates the levels that are needed to take any crop of _get_random_crop_rect
+    without downscaling the crop by more than a factor of two.
+
+    Args:
+        img: The full resolution image.
+
+    Returns: A list of images, starting with the full resolution image.
+    """
+
+    levels = [img]
+    max_crop_size = min(img.shape[0], img.shape[1]) / 4
+
+    while max_crop_size >= CROP_SIZE * 2 ** len(levels):
+        height, width = levels[-1].shape[:2]
+        levels.append(cv2.resize(levels[-1], (width // 2, height // 2), interpolation=cv2.INTER_AREA))
+
+    return levels
+
+
+def _get_random_crop_rect(height, width):
+    """Samples the square that is cropped out of a background.
+
+    Args:
+        height: The height of the background.
+        width: The width of the background.
+
+    Returns: A tuple (size, left, up) describing the square.
+    """
+
+    min_dim = min(height, width) / 4
+
+    # dont crop smaller than target size
+    scaled_size = max(int(random.random() * min_dim), CROP_SIZE)
+
+    left = random.randint(0, width - scaled_size)
+    up = random.randint(0, height - scaled_size)
+
+    return scaled_size, left, up
+
+
+def _get_random_background_crop(img):
+    """Randomly crops an image to a 128x128 rectangle.
+
+    Args:
+        img: The image to crop.
+
+    Returns: The cropped image.
+    """
+
+    height, width, channels = img.shape
+    scaled_size, left, up = _get_random_crop_rect(height, width)
+
+    img = img[up:up + scaled_size, left:left + scaled_size]
+    img = cv2.resize(img, (CROP_SIZE, CROP_SIZE))
+
+    return img
+
+
+def _get_random_pyramid_crop(levels):
+    """Randomly crops an image to a 128x128 rectangle using its downscaled versions.
+
+    The crop is taken from the smallest level that still has at least the target
+    resolution, so only a small final resize is needed. The crops follow the same
+    distribution as the ones of _get_random_background_crop.
+
+    Args:
+        levels: The image and its downscaled versions as created by _create_pyramid.
+
+    Returns: The cropped image.
+    """
+
+    height, width, channels = levels[0].shape
+    scaled_size, left, up = _get_random_crop_rect(height, width)
+
+    level = min(int(log2(scaled_size / CROP_SIZE)), len(levels) - 1)
+    factor = 2 ** level
+    size = scaled_size // factor
+    left //= factor
+    up //= factor
+
+    # the remaining downscale is less than a factor of two, which is cheap and does
+    # not alias with a bilinear resize
+    img = levels[level][up:up + size, left:left + size]
+    img = cv2.resize(img, (CROP_SIZE, CROP_SIZE))
+
+    return img
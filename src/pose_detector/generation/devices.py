@@ -0,0 +1,72 @@
+import multiprocessing
+import os
+
+# Device name used for rendering on the CPU instead of a GPU
+CPU = "cpu"
+
+
+def parse_devices(devices):
+    """Parses a comma separated list of render devices.
+
+    Args:
+        devices: A string like "0,1" listing GPU indices, "cpu" to render on the CPU, or
+          None to let every worker use all devices.
+
+    Returns:
+        The list of devices, None if devices is None.
+    """
+
+    if devices is None:
+        return None
+
+    parsed = [device.strip().lower() for device in devices.split(",") if device.strip()]
+    for device in parsed:
+        if device != CPU and not device.isdigit():
+            raise ValueError("Invalid render device '{}', expected a GPU index or '{}'".format(device, CPU))
+
+    return parsed
+
+
+def assign_devices(devices, workers, cpu_threads=None):
+    """Assigns a device to each render worker.
+
+    The workers are distributed evenly over the devices. Workers of a GPU only see that
+    GPU, workers on the CPU share its cores evenly unless cpu_threads is given.
+
+    Args:
+        devices: The devices as returned by parse_devices.
+        workers: How many workers render in parallel.
+        cpu_threads: How many threads each worker on the CPU uses.
+
+    Returns:
+        For each worker the environment variables of its Blenderproc process, None if it
+        should inherit the environment unchanged.
+    """
+
+    if not devices:
+        return [None] * workers
+
+    assigned = [devices[i % len(devices)] for i in range(workers)]
+
+    cpu_workers = assigned.count(CPU)
+    if cpu_threads is None and cpu_workers:
+        cpu_threads = max(multiprocessing.cpu_count() // cpu_workers, 1)
+
+    return [_device_env(device, cpu_threads) for device in assigned]
+
+
+def _device_env(device, cpu_threads):
+    """Returns the environment of a Blenderproc process rendering on a device.
+    """
+
+    env = dict(os.environ)
+    if device == CPU:
+        # hides all GPUs, the Initializer falls back to the CPU
+        env["CUDA_VISIBLE_DEVICES"] = ""
+        env["BLENDER_PROC_DEVICE"] = "CPU"
+        env["BLENDER_PROC_CPU_THREADS"] = str(cpu_threads)
+    else:
+        env["CUDA_VISIBLE_DEVICES"] = device
+        env["BLENDER_PROC_DEVICE"] = "GPU"
+
+    return env
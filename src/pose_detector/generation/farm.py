@@ -0,0 +1,384 @@
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+from collections import deque
+from multiprocessing.connection import Client, Listener, AuthenticationError
+
+from pose_detector.generation import rendering
+from pose_detector.generation.devices import assign_devices, parse_devices
+from pose_detector.generation.images import rendered_images
+from pose_detector.generation.labels import LABELS_NAME
+from pose_detector.generation.presets import write_preset_config
+from pose_detector.generation.rendering import RenderWorker, OUTPUT_LINES
+
+# How many seconds a render node waits between sending two heartbeats
+HEARTBEAT_INTERVAL = 5
+
+# A render node that sent nothing for this many seconds is considered lost
+HEARTBEAT_TIMEOUT = 30
+
+# How many seconds a render node tries to connect to a coordinator that is not running yet
+CONNECT_TIMEOUT = 60
+
+
+class Coordinator:
+    """Hands out render chunks to render nodes connecting over TCP.
+
+    Every connection of a node renders one chunk after another, like a local worker. If
+    a node disconnects or stops sending heartbeats, the images of its current chunk that
+    were not received yet are put back into the queue for the other nodes. Nodes can
+    connect at any time until all images are rendered.
+
+    Attributes:
+        address: The (host, port) to listen on.
+        authkey: The key the nodes have to authenticate with.
+        nodes: How many node connections are currently active.
+    """
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self.nodes = 0
+
+        self._lock = threading.Lock()
+        self._closing = False
+
+    def serve(self, scheduler, work):
+        """Serves chunks to the connecting nodes until all images are rendered.
+
+        Args:
+            scheduler: The Scheduler handing out the chunks.
+            work: Called with a RemoteWorker for each connection, renders chunks with it
+              until all images are rendered.
+        """
+
+        listener = Listener(self.address, authkey=self.authkey)
+        print("Waiting for render nodes on {}:{}".format(*listener.address))
+
+        threads = []
+        acceptor = threading.Thread(target=self._accept, args=(listener, scheduler, work, threads), daemon=True)
+        acceptor.start()
+
+        try:
+            scheduler.wait_finished()
+        finally:
+            # accept can not be interrupted, so the listener connects to itself to stop it
+            self._closing = True
+            try:
+                Client(listener.address, authkey=self.authkey).close()
+            except OSError:
+                pass
+            acceptor.join()
+            listener.close()
+
+        for thread in threads:
+            thread.join()
+
+    def _accept(self, listener, scheduler, work, threads):
+        """Accepts the connections of nodes and serves each of them on its own thread.
+        """
+
+        while True:
+            try:
+                conn = listener.accept()
+            except AuthenticationError:
+                print("A render node failed to authenticate")
+                continue
+            except (EOFError, OSError) as e:
+                # a node dropping the connection during the handshake must not stop the others from connecting
+                if self._closing:
+                    return
+                print("Failed to accept a render node: {!r}".format(e))
+                continue
+
+            if self._closing:
+                conn.close()
+                return
+
+            worker = RemoteWorker(conn, "{}:{}".format(*listener.last_accepted))
+            thread = threading.Thread(target=self._serve_node, args=(worker, scheduler, work))
+            thread.start()
+            threads.append(thread)
+
+    def _serve_node(self, worker, scheduler, work):
+        """Renders chunks on a node until all images are rendered or the node is lost.
+        """
+
+        with self._lock:
+            self.nodes += 1
+            scheduler.workers = self.nodes
+
+        print("Render node {} connected".format(worker.name))
+        try:
+            work(worker)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            worker.disconnect()
+            with self._lock:
+                self.nodes -= 1
+
+
+class RemoteWorker:
+    """Renders chunks on a render node connected to the coordinator.
+
+    Has the same interface as a RenderWorker. The node renders the chunks with its own
+    RenderWorker and sends back the rendered frames, the telemetry events and the output
+    of Blenderproc.
+
+    Attributes:
+        name: The address of the node.
+        output: The last OUTPUT_LINES lines Blenderproc printed on the node during the
+          current chunk, apart from the events.
+        returncode: The exit code of the last process on the node that exited, None if none did.
+        lost: Whether the connection to the node was lost.
+    """
+
+    def __init__(self, conn, name):
+        self.name = name
+        self.output = deque(maxlen=OUTPUT_LINES)
+        self.returncode = None
+        self.lost = False
+
+        self._conn = conn
+
+    def render(self, tmp_dir, model_path, count, seed=None, on_event=None):
+        """Renders a chunk on the node and waits for it to finish.
+
+        The frames are written to tmp_dir as soon as they are received.
+
+        Args:
+            tmp_dir: The directory the rendered images of this chunk are written to.
+            model_path: The model to use for rendering this chunk, the node renders the
+              model with the same file name from its own models directory.
+            count: How many images should be rendered.
+            seed: The random seed used for the chunk, None to not seed it.
+            on_event: Called with every telemetry event of the chunk.
+
+        Returns:
+            The event ending the chunk, None if the process on the node exited or the node
+            was lost. Its times are replaced with the times the start of the chunk was sent
+            and its first frame and its end were received, so they are measured with the
+            clock of the coordinator even if the clock of the node differs.
+        """
+
+        if self.lost:
+            return None
+
+        self.output.clear()
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+
+        try:
+            started = time.time()
+            first_frame = None
+            self._conn.send(("render", pathlib.Path(model_path).name, count, seed))
+
+            while True:
+                if not self._conn.poll(HEARTBEAT_TIMEOUT):
+                    print("Render node {} did not respond for {}s".format(self.name, HEARTBEAT_TIMEOUT))
+                    self._lose()
+                    return None
+
+                message = self._conn.recv()
+                if message[0] == "frame":
+                    # replaced atomically, the processing may already read the files while streaming
+                    _, name, data = message
+                    tmp_path = tmp_dir.joinpath(name + ".tmp")
+                    tmp_path.write_bytes(data)
+                    os.replace(tmp_path, tmp_dir.joinpath(name))
+                elif message[0] == "event":
+                    if message[1]["event"] == "frame" and first_frame is None:
+                        first_frame = time.time()
+                    if on_event is not None:
+                        on_event(message[1])
+                elif message[0] == "report":
+                    _, report, self.returncode, output = message
+                    self.output.extend(output)
+                    if report is not None:
+                        report.update(started=started, ended=time.time(),
+                                      first_frame=first_frame if report["first_frame"] is not None else None)
+                    return report
+        except (OSError, EOFError):
+            print("Lost the connection to render node {}".format(self.name))
+            self._lose()
+            return None
+
+    def close(self):
+        """Stops the process on the node, the next chunk starts a new one.
+        """
+
+        if self.lost:
+            return
+
+        try:
+            self._conn.send(("close",))
+        except OSError:
+            self._lose()
+
+    def disconnect(self):
+        """Tells the node that there is nothing left to render and closes the connection.
+        """
+
+        if not self.lost:
+            try:
+                self._conn.send(("done",))
+            except OSError:
+                pass
+
+        self._lose()
+
+    def _lose(self):
+        """Closes the connection to the node.
+        """
+
+        self.lost = True
+        self._conn.close()
+
+
+def run_node(address, config_path, models_path, farm_key, parallel=1, devices=None, cpu_threads=None, preset=None):
+    """Runs a render node rendering chunks for a coordinator.
+
+    Each of the parallel workers connects to the coordinator on its own and renders the
+    chunks it is handed out with a RenderWorker. The frames are sent to the coordinator
+    as soon as they are written. The node stops once the coordinator has nothing left
+    to render.
+
+    Args:
+        address: The address of the coordinator as "host:port".
+        config_path: The path to the configuration file for Blenderproc.
+        models_path: The path to a directory containing the .blend files, it must contain
+          the same models as the one of the coordinator.
+        farm_key: The key to authenticate with at the coordinator.
+        parallel: How many chunks are rendered in parallel.
+        devices: The devices to render on as a comma separated string, see devices.parse_devices.
+        cpu_threads: How many threads each worker rendering on the CPU uses.
+        preset: The name of a render preset from presets.PRESETS, it must be the same as
+          the one of the coordinator.
+    """
+
+    # Blenderproc will change the working directory so we need to resolve these paths
+    config_path = config_path.resolve()
+    models_path = models_path.resolve()
+
+    with tempfile.TemporaryDirectory(prefix="render_node_config_") as tmp:
+        if preset is not None:
+            config_path = write_preset_config(config_path, preset, pathlib.Path(tmp))
+
+        threads = []
+        for env in assign_devices(parse_devices(devices), parallel, cpu_threads):
+            thread = threading.Thread(target=_run_connection,
+                                      args=(parse_address(address), farm_key.encode(), config_path, models_path, env))
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+
+def parse_address(address):
+    """Parses an address like "host:port", the host defaults to localhost.
+
+    Returns:
+        A tuple (host, port).
+    """
+
+    host, _, port = address.rpartition(":")
+    return host or "localhost", int(port)
+
+
+def _run_connection(address, authkey, config_path, models_path, env):
+    """Renders the chunks the coordinator hands out over a single connection.
+    """
+
+    conn = _connect(address, authkey)
+    lock = threading.Lock()
+    stopped = threading.Event()
+
+    def send(message):
+        with lock:
+            conn.send(message)
+
+    def heartbeat():
+        while not stopped.wait(HEARTBEAT_INTERVAL):
+            try:
+                send(("heartbeat",))
+            except OSError:
+                return
+
+    root = rendering._get_root_path()
+    worker = RenderWorker(root.joinpath("tools/BlenderProc/run.py"), config_path, root.joinpath("tools/blender"), env)
+    threading.Thread(target=heartbeat, daemon=True).start()
+
+    try:
+        with tempfile.TemporaryDirectory(prefix="render_node_") as tmp:
+            tmp_dir = pathlib.Path(tmp).joinpath("chunk")
+
+            while True:
+                message = conn.recv()
+                if message[0] == "close":
+                    worker.close()
+                    continue
+                if message[0] != "render":
+                    return
+
+                _, model_name, count, seed = message
+                if tmp_dir.exists():
+                    shutil.rmtree(tmp_dir)
+
+                sent = set()
+
+                # every frame is complete once its event is emitted, so it is sent first
+                def on_event(event):
+                    if event["event"] == "frame":
+                        _send_frames(send, tmp_dir, sent)
+                    send(("event", event))
+
+                report = worker.render(tmp_dir, models_path.joinpath(model_name), count, seed, on_event=on_event)
+                _send_frames(send, tmp_dir, sent)
+                send(("report", report, worker.returncode, list(worker.output)))
+    except (OSError, EOFError):
+        print("Lost the connection to the coordinator")
+    finally:
+        stopped.set()
+        worker.close()
+        conn.close()
+
+
+def _connect(address, authkey):
+    """Connects to the coordinator, waiting up to CONNECT_TIMEOUT seconds for it to start.
+    """
+
+    waited = 0
+    while True:
+        try:
+            return Client(address, authkey=authkey)
+        except ConnectionRefusedError:
+            if waited >= CONNECT_TIMEOUT:
+                raise
+
+            if waited == 0:
+                print("Waiting for the coordinator on {}:{}".format(*address))
+            time.sleep(HEARTBEAT_INTERVAL)
+            waited += HEARTBEAT_INTERVAL
+
+
+def _send_frames(send, tmp_dir, sent):
+    """Sends all frames in tmp_dir that were not sent yet, along with the label sidecar.
+    """
+
+    for img_path in rendered_images(tmp_dir):
+        if img_path.name not in sent:
+            send(("frame", img_path.name, img_path.read_bytes()))
+            sent.add(img_path.name)
+
+    # the sidecar is rewritten every few frames and at the end of the chunk, so it is sent again whenever it changed
+    labels_path = tmp_dir.joinpath(LABELS_NAME)
+    if labels_path.exists():
+        version = (LABELS_NAME, labels_path.stat().st_mtime_ns)
+        if version not in sent:
+            send(("frame", LABELS_NAME, labels_path.read_bytes()))
+            sent.add(version)
@@ -1,18 +1,35 @@
+import shutil
+import threading
+from timeit import default_timer as timer
+
 from pose_detector.generation import processing
+from pose_detector.generation.backgrounds import load_weights
+from pose_detector.generation.devices import parse_devices
+from pose_detector.generation.farm import Coordinator, parse_address
+from pose_detector.generation.presets import write_preset_config
+from pose_detector.generation.progress import Progress
 from pose_detector.generation.rendering import Renderer
 
 
-def generate_dataset(size, config_path, models_path, backgrounds_path, output_path, parallel=1, mode="all"):
+def generate_dataset(size, config_path, models_path, backgrounds_path, output_path, parallel=1, mode="all",
+                     background_weights=None, background_memory=4096, background_mode="crop", crop_pool_size=10000,
+                     stream=False, output_format="png", shard_size=1000, fresh_processes=False,
+                     render_retries=2, seed=None, devices=None, cpu_threads=None, farm=None, farm_key=None,
+                     preset=None, keep_alpha=False):
     """Generates a dataset.
 
     Generates a dataset by rendering images using Blenderproc and then processing them
     further. Images are all saved to a single directory.
 
+    The state of each render chunk is tracked in a "progress.json" in the output directory.
+    Running the same command again after an interruption skips the chunks that are already
+    rendered or processed and only renders missing or corrupt chunks again.
+
     The label for each image must be specified in the config file. It is encoded in the
     output name of each file, using the following format: "<img_num>_<label>.png"
 
     Args:
-        size: The target size of the dataset to generate.
+        size: The size of the dataset to generate.
         models_path: The path to a directory containing .blend files with the models that should be rendered.
         config_path: The path to the configuration file for Blenderproc. It must follow the
           the config format specified in the Blenderproc documentation. It is also required
@@ -25,6 +42,42 @@ def generate_dataset(size, config_path, models_path, backgrounds_path, output_pa
           "all": Render and process
           "render": Only perform the rendering step
           "process": Only perform the processing step
+        background_weights: Path of a .yaml file mapping background file names to how likely
+          they are used. Backgrounds not listed get a weight of 1.
+        background_memory: How many MB the decoded backgrounds may take up before they are
+          decoded on demand instead.
+        background_mode: How the background crops are created; Options:
+          "crop": Crop the full resolution background and resize it
+          "pyramid": Crop the nearest pre-downscaled version of the background and resize it
+          "pool": Draw from a pool of crops that is created in advance
+        crop_pool_size: How many crops are created in advance in the "pool" mode.
+        stream: Whether the images should be processed while they are being rendered, only
+          used in the "all" mode.
+        output_format: How the images are stored; Options:
+          "png": Each image is stored as "<img_num>_<label>.png"
+          "tfrecord": The images are stored in TFRecord shards described by a "manifest.json"
+          "raw": The pixels of all images are stored in a single file "images.u8" that can be
+            memory-mapped, described by a "header.json"
+        shard_size: How many images are stored in a single TFRecord shard.
+        fresh_processes: Whether a new Blenderproc process is started for every chunk of
+          images, instead of keeping one running per parallel process.
+        render_retries: How often the images of a chunk are rendered again with a new seed
+          if Blenderproc fails or writes fewer images than expected.
+        seed: The seed of the dataset. Each render chunk gets a distinct seed derived from
+          it and each image is processed with a seed derived from it and its number. If None
+          the dataset is generated randomly.
+        devices: The devices to render on as a comma separated string of GPU indices or
+          "cpu", the parallel workers are distributed evenly over them. If None every worker
+          uses all GPUs.
+        cpu_threads: How many threads each worker rendering on the CPU uses, by default the
+          cores are shared evenly between them.
+        farm: If given, the images are rendered by render nodes connecting to this address,
+          given as "host:port", instead of local processes.
+        farm_key: The key the render nodes have to authenticate with, required for farm.
+        preset: The name of a render preset from presets.PRESETS, its settings replace the
+          ones of the renderer in the config. If None the config is used as it is.
+        keep_alpha: Whether the rendered images are stored with their alpha channel, without
+          backgrounds, flips and rotations, so they are augmented during the training instead.
     """
 
     # Blenderproc will change the working directory so we need to resolve these paths
@@ -34,15 +87,133 @@ def generate_dataset(size, config_path, models_path, backgrounds_path, output_pa
     output_path = output_path.resolve()
     backgrounds_path = backgrounds_path.resolve()
 
+    # tracks which chunks are already rendered and processed, so an interrupted generation
+    # continues where it stopped when the same command is run again
+    output_path.mkdir(parents=True, exist_ok=True)
+    progress = Progress(output_path)
+
+    if preset is not None:
+        config_path = write_preset_config(config_path, preset, output_path)
+
+    coordinator = None
+    if farm is not None:
+        if not farm_key:
+            raise ValueError("A key is required for rendering with render nodes")
+        coordinator = Coordinator(parse_address(farm), farm_key.encode())
+
+    stream = stream and mode == "all"
+    renderer = None
+    rendering = None
+
     if mode == "all" or mode == "render":
         renderer = Renderer(count=size,
                             config_path=config_path,
                             model_paths=list(models_path.glob("*.blend")),
                             output_path=output_path,
-                            parallel=parallel)
-        renderer.render()
+                            parallel=parallel,
+                            progress=progress,
+                            fresh_processes=fresh_processes,
+                            retries=render_retries,
+                            seed=seed,
+                            devices=parse_devices(devices),
+                            cpu_threads=cpu_threads,
+                            coordinator=coordinator)
+
+        if stream:
+            # the images are processed on the main thread during the rendering
+            rendering = threading.Thread(target=renderer.render)
+            rendering.start()
+        else:
+            renderer.render()
 
     if mode == "all" or mode == "process":
-        processing.process_images(backgrounds=list(backgrounds_path.glob("*.jpg")),
-                           output_path=output_path,
-                           delete_tmp=-True)
+        backgrounds = sorted(backgrounds_path.glob("*.jpg"))
+        processing.process_images(backgrounds=backgrounds,
+                                  output_path=output_path,
+                                  delete_tmp=True,
+                                  parallel=parallel,
+                                  background_weights=load_weights(background_weights, backgrounds),
+                                  background_memory=background_memory * 1024 * 1024,
+                                  background_mode=background_mode,
+                                  crop_pool_size=crop_pool_size,
+                                  renderer=renderer if stream else None,
+                                  output_format=output_format,
+                                  shard_size=shard_size,
+                                  progress=progress,
+                                  seed=seed,
+                                  keep_alpha=keep_alpha)
+
+    if rendering is not None:
+        rendering.join()
+
+
+def benchmark_rendering(config_path, models_path, output_path, devices=None, max_workers=4, size=100,
+                        cpu_threads=None):
+    """Finds how many render workers per device render the fastest.
+
+    Renders the same number of images with 1 to max_workers workers per device and
+    prints the throughput of each. The rendered images are deleted afterwards.
+
+    Args:
+        config_path: The path to the configuration file for Blenderproc.
+        models_path: The path to a directory containing the .blend files to render.
+        output_path: Directory where the images are temporarily stored.
+        devices: The devices to render on as a comma separated string, see parse_devices.
+        max_workers: The largest number of workers per device that is tried.
+        size: How many images are rendered per device in each run.
+        cpu_threads: How many threads each worker on the CPU uses, by default the cores
+          are shared evenly.
+
+    Returns:
+        The number of workers per device with the highest throughput.
+    """
+
+    models_path = models_path.resolve()
+    config_path = config_path.resolve()
+    output_path = output_path.resolve()
+
+    devices = parse_devices(devices)
+    device_count = len(devices) if devices else 1
+    count = size * device_count
+
+    results = {}
+    for workers in range(1, max_workers + 1):
+        run_path = output_path.joinpath("benchmark_{}".format(workers))
+        if run_path.exists():
+            shutil.rmtree(run_path)
+        run_path.mkdir(parents=True)
+
+        parallel = workers * device_count
+        renderer = Renderer(count=count,
+                            config_path=config_path,
+                            model_paths=list(models_path.glob("*.blend")),
+                            output_path=run_path,
+                            parallel=parallel,
+                            devices=devices,
+                            cpu_threads=cpu_threads)
+
+        start = timer()
+        renderer.render()
+        duration = timer() - start
+
+        shutil.rmtree(run_path)
+
+        if renderer.failed:
+            print("{} workers per device failed, stopping the benchmark".format(workers))
+            break
+
+        results[workers] = count / duration
+        print("{} workers per device: {:.2f} images/s".format(workers, results[workers]))
+
+    if not results:
+        raise RuntimeError("No benchmark run finished without failures")
+
+    print()
+    print("workers per device | images/s")
+    for workers, rate in results.items():
+        print("{:>18} | {:.2f}".format(workers, rate))
+
+    best = max(results, key=results.get)
+    print("The fastest setting is {} workers per device, use --parallel {}".format(best, best * device_count))
+
+    return best
@@ -0,0 +1,67 @@
+import cv2
+import numpy as np
+
+# File extensions of the images Blenderproc renders, uncompressed .tga images are written
+# with image_type "TGA" and skip the png encoding and decoding
+RENDER_EXTENSIONS = (".png", ".tga")
+
+# Size of the header of a .tga image
+TGA_HEADER_SIZE = 18
+
+# Image type of an uncompressed true color .tga image
+TGA_UNCOMPRESSED = 2
+
+
+def rendered_images(tmp_dir):
+    """Lists the rendered images in the temporary output directory of a chunk.
+
+    Returns:
+        The sorted paths of the images.
+    """
+
+    return sorted(path for path in tmp_dir.glob("*") if path.suffix in RENDER_EXTENSIONS)
+
+
+def read_rendered_image(img_path):
+    """Reads a rendered image, keeping its alpha channel.
+
+    Args:
+        img_path: The path of a .png or an uncompressed .tga image.
+
+    Returns:
+        The image as an uint8 array in the BGR(A) channel order of opencv.
+    """
+
+    if img_path.suffix == ".tga":
+        return _read_tga(img_path)
+
+    return cv2.imread(str(img_path), cv2.IMREAD_UNCHANGED)
+
+
+def _read_tga(img_path):
+    """Reads an uncompressed .tga image, which opencv does not support.
+
+    The pixels of a .tga image are already stored in BGR(A) order, so they only need to be
+    reshaped and flipped to the top-left origin.
+    """
+
+    data = np.fromfile(img_path, dtype=np.uint8)
+
+    header = data[:TGA_HEADER_SIZE].tolist()
+    id_length, color_map_type, image_type = header[0:3]
+    width = header[12] | header[13] << 8
+    height = header[14] | header[15] << 8
+    channels = header[16] // 8
+    descriptor = header[17]
+
+    if image_type != TGA_UNCOMPRESSED or color_map_type != 0 or channels not in (3, 4):
+        raise ValueError("{} is not an uncompressed true color .tga image".format(img_path))
+
+    offset = TGA_HEADER_SIZE + id_length
+    img = data[offset:offset + width * height * channels].reshape((height, width, channels))
+
+    # bit 5 of the descriptor is set if the first row is the top one
+    if not descriptor & 0x20:
+        img = img[::-1]
+
+    return np.ascontiguousarray(img)
@@ -0,0 +1,220 @@
+import os
+
+import numpy as np
+
+# Name of the label sidecar, the LabelSidecarWriter writes one into each chunk and the
+# processing joins them into one for the whole dataset
+LABELS_NAME = "labels.npz"
+
+# Column of a chunk sidecar holding the frame number of each row
+FRAME_COLUMN = "frame"
+
+# Column of a dataset sidecar holding the image number of each row
+NUM_COLUMN = "num"
+
+
+def read_chunk_labels(tmp_dir):
+    """Reads the label sidecar of a chunk.
+
+    Args:
+        tmp_dir: The temporary output directory of the chunk.
+
+    Returns:
+        A dict mapping the frame numbers to dicts of the labels of the frame, None if the
+        chunk has no sidecar.
+    """
+
+    path = tmp_dir.joinpath(LABELS_NAME)
+    if not path.exists():
+        return None
+
+    with np.load(str(path)) as data:
+        columns = {key: data[key] for key in data.files}
+
+    frames = columns.pop(FRAME_COLUMN)
+    return {int(frame): {key: values[i] for key, values in columns.items()} for i, frame in enumerate(frames)}
+
+
+class LabelTable:
+    """Collects the labels of the processed images and stores them in the dataset sidecar.
+
+    The sidecar contains one array per label and the NUM_COLUMN array with the numbers of
+    the images, so the labels can be joined to the images of any output format. If the
+    directory already contains a sidecar, new labels are added to the existing ones.
+
+    The labels are kept in numpy arrays that grow as images are added, a checkpoint only
+    converts the labels added since the previous one, so the cost of a checkpoint does not
+    grow with the number of checkpoints before it.
+
+    Attributes:
+        output_path: Directory where the sidecar is stored.
+        size: How many images have labels.
+    """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.size = 0
+
+        self._nums = np.zeros(0, dtype=np.int64)
+        self._columns = None
+        self._rows = {}
+        self._added = []
+
+        if output_path.joinpath(LABELS_NAME).exists():
+            columns = read_labels(output_path)
+            self._append(columns.pop(NUM_COLUMN), columns)
+
+    def add(self, num, labels):
+        """Adds the labels of an image.
+
+        Args:
+            num: The number of the image across all runs.
+            labels: A dict of the labels of the image.
+        """
+
+        self._added.append((num, labels))
+
+    def checkpoint(self):
+        """Writes the sidecar, nothing is written if no image has labels. Labels can still be
+        added afterwards.
+        """
+
+        if self._added:
+            # only labels all images have become columns
+            keys = [key for key in self._added[0][1] if all(key in labels for _, labels in self._added)]
+            nums = np.array([num for num, _ in self._added], dtype=np.int64)
+            columns = {key: np.array([labels[key] for _, labels in self._added], dtype=np.float32) for key in keys}
+            self._append(nums, columns)
+            self._added = []
+
+        if not self.size:
+            return
+
+        columns = {NUM_COLUMN: self._nums[:self.size]}
+        columns.update((key, values[:self.size]) for key, values in self._columns.items())
+
+        path = self.output_path.joinpath(LABELS_NAME)
+        tmp_path = self.output_path.joinpath(LABELS_NAME + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **columns)
+        os.replace(tmp_path, path)
+
+    def close(self):
+        """Writes the sidecar, nothing is written if no image has labels.
+        """
+
+        self.checkpoint()
+
+    def _append(self, nums, columns):
+        """Stores the labels of images, replacing the labels of images that were added before.
+
+        Args:
+            nums: An array with the numbers of the images.
+            columns: A dict mapping the names of the labels to arrays with a row per image.
+        """
+
+        if self._columns is None:
+            self._columns = {key: np.zeros((0,) + values.shape[1:], dtype=np.float32)
+                             for key, values in columns.items()}
+        else:
+            self._columns = {key: values for key, values in self._columns.items() if key in columns}
+
+        rows = np.empty(len(nums), dtype=np.int64)
+        for i, num in enumerate(nums):
+            row = self._rows.get(int(num))
+            if row is None:
+                row = self._rows[int(num)] = self.size
+                self.size += 1
+            rows[i] = row
+
+        # the capacity is doubled, so every label is only copied a few times in total
+        if self.size > len(self._nums):
+            capacity = max(self.size, 2 * len(self._nums))
+            self._nums = _grow(self._nums, capacity)
+            self._columns = {key: _grow(values, capacity) for key, values in self._columns.items()}
+
+        self._nums[rows] = nums
+        for key, values in self._columns.items():
+            values[rows] = columns[key]
+
+
+def _grow(array, capacity):
+    """Copies an array into a larger one with capacity rows.
+    """
+
+    grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def has_labels(data_dir):
+    """Whether a dataset directory contains a label sidecar.
+    """
+
+    return data_dir.joinpath(LABELS_NAME).exists()
+
+
+def read_labels(data_dir):
+    """Reads the label sidecar of a dataset.
+
+    Returns:
+        A dict mapping the column names to arrays, NUM_COLUMN contains the image numbers.
+    """
+
+    with np.load(str(data_dir.joinpath(LABELS_NAME))) as data:
+        return {key: data[key] for key in data.files}
+
+
+def label_sizes(data_dir, targets):
+    """Returns how many values each of the targets has in the label sidecar of a dataset.
+
+    Only reads the small sidecar, so it is meant to check the targets before a model is built.
+
+    Returns:
+        A dict mapping the targets to their number of values, in the order of targets.
+    """
+
+    columns = _read_targets(data_dir, targets)
+    return {target: int(np.prod(columns[target].shape[1:])) for target in targets}
+
+
+def join_labels(data_dir, nums, targets):
+    """Looks up the labels of images in the dataset sidecar.
+
+    Args:
+        data_dir: The dataset directory containing the sidecar.
+        nums: The numbers of the images.
+        targets: The names of the labels, labels with several values like "camera_location"
+          contribute all of them.
+
+    Returns:
+        A float32 array of shape (len(nums), number of values), each row containing the
+        values of the targets of an image in order.
+    """
+
+    columns = _read_targets(data_dir, targets)
+    rows = {int(num): i for i, num in enumerate(columns[NUM_COLUMN])}
+    try:
+        indices = np.array([rows[int(num)] for num in nums], dtype=np.int64)
+    except KeyError as e:
+        raise ValueError("The labels of {} contain no image {}".format(data_dir, e.args[0]))
+
+    values = [columns[target].reshape((len(columns[NUM_COLUMN]), -1)) for target in targets]
+    return np.concatenate(values, axis=1)[indices].astype(np.float32)
+
+
+def _read_targets(data_dir, targets):
+    """Reads the label sidecar of a dataset and checks that it contains all targets.
+    """
+
+    if not has_labels(data_dir):
+        raise ValueError("{} contains no label sidecar, it is only written if the config contains a "
+                         "renderer.LabelSidecarWriter".format(data_dir))
+
+    columns = read_labels(data_dir)
+    missing = [target for target in targets if target not in columns or target == NUM_COLUMN]
+    if missing:
+        raise ValueError("The labels of {} contain no {}, available: {}".format(
+            data_dir, ", ".join(missing), ", ".join(key for key in columns if key != NUM_COLUMN)))
+
+    return columns
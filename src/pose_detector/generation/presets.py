@@ -0,0 +1,196 @@
+import math
+import shutil
+
+import numpy as np
+import yaml
+
+from pose_detector.generation import rendering
+from pose_detector.generation.devices import assign_devices, parse_devices
+from pose_detector.generation.images import read_rendered_image, rendered_images
+from pose_detector.generation.rendering import RenderWorker
+
+# Render settings of the presets, they replace the settings of the RgbRenderer module in the
+# config, a "module" replaces the module itself. The images are only 128x128 pixels, so far
+# fewer samples and bounces suffice than the Blenderproc defaults of 256 samples and 3
+# bounces, the denoiser removes most of the remaining noise.
+PRESETS = {
+    "draft": {
+        "samples": 16,
+        "use_adaptive_sampling": 0.1,
+        "max_bounces": 1,
+        "diffuse_bounces": 1,
+        "glossy_bounces": 0,
+        "transparency_bounces": 4,
+    },
+    "train": {
+        "samples": 48,
+        "use_adaptive_sampling": 0.05,
+        "max_bounces": 2,
+        "diffuse_bounces": 2,
+        "glossy_bounces": 1,
+        "transparency_bounces": 8,
+    },
+    "hq": {
+        "samples": 256,
+        "max_bounces": 4,
+        "diffuse_bounces": 3,
+        "glossy_bounces": 2,
+        "transparency_bounces": 8,
+    },
+    # The rasterizing engines replace the RgbRenderer with the RasterRenderer, they do not trace
+    # any bounces and render a small image much faster than Cycles, but with less accurate lighting.
+    "eevee": {
+        "module": "renderer.RasterRenderer",
+        "engine": "EEVEE",
+        "samples": 16,
+    },
+    "workbench": {
+        "module": "renderer.RasterRenderer",
+        "engine": "WORKBENCH",
+        "samples": 8,
+    },
+}
+
+# The preset the other presets are compared against by the calibration
+REFERENCE_PRESET = "hq"
+
+# The module the settings of a preset are applied to
+RENDERER_MODULE = "renderer.RgbRenderer"
+
+
+def write_preset_config(config_path, preset, output_path):
+    """Writes a copy of a Blenderproc config with the render settings of a preset.
+
+    Args:
+        config_path: The path to the configuration file for Blenderproc.
+        preset: The name of the preset, one of PRESETS.
+        output_path: Directory where the config is written to.
+
+    Returns:
+        The path of the written config.
+    """
+
+    with open(config_path, "r") as f:
+        config = yaml.safe_load(f)
+
+    renderers = [module for module in config["modules"] if module["module"] == RENDERER_MODULE]
+    if not renderers:
+        raise ValueError("{} contains no {} module to apply the preset to".format(config_path, RENDERER_MODULE))
+
+    settings = dict(PRESETS[preset])
+    module_name = settings.pop("module", RENDERER_MODULE)
+    for module in renderers:
+        module["module"] = module_name
+        module.setdefault("config", {}).update(settings)
+
+    preset_config_path = output_path.joinpath("config_{}.yaml".format(preset))
+    with open(preset_config_path, "w") as f:
+        yaml.safe_dump(config, f, sort_keys=False)
+
+    return preset_config_path
+
+
+def calibrate_presets(config_path, models_path, output_path, size=10, seed=0, devices=None, cpu_threads=None):
+    """Compares the render time and the image quality of the presets.
+
+    Renders the same images of each model with every preset, then prints the seconds per
+    frame of each preset and how much its images differ from the ones of REFERENCE_PRESET.
+    The rendered images are deleted afterwards.
+
+    Args:
+        config_path: The path to the configuration file for Blenderproc.
+        models_path: The path to a directory containing the .blend files to render.
+        output_path: Directory where the images are temporarily stored.
+        size: How many images of each model are rendered per preset.
+        seed: The seed used for rendering, so all presets render the same poses.
+        devices: The device to render on, see devices.parse_devices.
+        cpu_threads: How many threads a worker rendering on the CPU uses.
+
+    Returns:
+        For each preset a dict with the "seconds_per_frame", the mean absolute error "mae"
+        and the "psnr" compared to REFERENCE_PRESET.
+    """
+
+    config_path = config_path.resolve()
+    models_path = models_path.resolve()
+    output_path = output_path.resolve()
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    model_paths = sorted(models_path.glob("*.blend"))
+    root = rendering._get_root_path()
+    env = assign_devices(parse_devices(devices), 1, cpu_threads)[0]
+
+    # the reference is rendered first, so the others can be compared to it right away
+    presets = [REFERENCE_PRESET] + [preset for preset in PRESETS if preset != REFERENCE_PRESET]
+
+    results = {}
+    reference = {}
+    for preset in presets:
+        preset_config_path = write_preset_config(config_path, preset, output_path)
+        worker = RenderWorker(root.joinpath("tools/BlenderProc/run.py"), preset_config_path,
+                              root.joinpath("tools/blender"), env)
+
+        render_time = 0
+        frames = 0
+        errors = []
+        try:
+            for model_path in model_paths:
+                tmp_dir = output_path.joinpath("calibration_{}_{}".format(preset, model_path.stem))
+                if tmp_dir.exists():
+                    shutil.rmtree(tmp_dir)
+
+                report = worker.render(tmp_dir, model_path, size, seed)
+                if report is None or report["status"] != "done":
+                    raise RuntimeError("Rendering {} with the {} preset failed:\n{}".format(
+                        model_path.stem, preset, "\n".join(worker.output)))
+
+                # the first frame also contains the time blender took to start
+                if report["first_frame"] is not None and report["frames"] > 1:
+                    render_time += report["ended"] - report["first_frame"]
+                    frames += report["frames"] - 1
+
+                images = _read_images(tmp_dir)
+                shutil.rmtree(tmp_dir)
+
+                if preset == REFERENCE_PRESET:
+                    reference[model_path] = images
+                else:
+                    errors += [np.abs(images[frame] - reference[model_path][frame])
+                               for frame in images if frame in reference[model_path]]
+        finally:
+            worker.close()
+            preset_config_path.unlink()
+
+        mae = float(np.mean(errors)) if errors else 0.0
+        mse = float(np.mean(np.square(errors))) if errors else 0.0
+        results[preset] = {
+            "seconds_per_frame": render_time / frames if frames else None,
+            "mae": mae,
+            "psnr": 10 * math.log10(255 ** 2 / mse) if mse > 0 else math.inf,
+        }
+
+    print()
+    print("   preset | seconds/frame |    MAE |   PSNR")
+    for preset in PRESETS:
+        result = results[preset]
+        seconds = "{:13.3f}".format(result["seconds_per_frame"]) if result["seconds_per_frame"] is not None \
+            else "{:>13}".format("-")
+        print("{:>9} | {} | {:6.2f} | {:6.2f}".format(preset, seconds, result["mae"], result["psnr"]))
+
+    return results
+
+
+def _read_images(tmp_dir):
+    """Reads the rendered images of a chunk.
+
+    Returns:
+        A dict mapping the frame numbers to the images as float arrays.
+    """
+
+    images = {}
+    for img_path in rendered_images(tmp_dir):
+        # the images are named "<label>_<frame>.png"
+        frame = int(img_path.stem.split("_")[1])
+        images[frame] = read_rendered_image(img_path).astype(np.float32)
+
+    return images
@@ -1,75 +1,345 @@
 import os
 import random
+import shutil
+import time
+from concurrent.futures.process import ProcessPoolExecutor
+from functools import partial
 from timeit import default_timer as timer
 import cv2
 import numpy as np
 
+from pose_detector.generation.backgrounds import BackgroundBank, DEFAULT_MAX_MEMORY
+from pose_detector.generation.images import read_rendered_image, rendered_images
+from pose_detector.generation.labels import LABELS_NAME, LabelTable, read_chunk_labels
+from pose_detector.generation.progress import Progress, RENDERED
+from pose_detector.generation.records import create_writer
 
-def process_images(backgrounds, output_path, delete_tmp=True):
+# Each task sent to a worker process contains at most this many images, this keeps
+# the load balanced even when there are only a few large render runs
+MAX_PER_TASK = 250
+
+# How many seconds to wait between looking for new images while streaming
+POLL_INTERVAL = 1
+
+# Images only count as processed once the writer, the labels and the progress are
+# checkpointed, which happens after this many images. Until then their rendered images
+# are kept, so at most this many of them pile up.
+CHECKPOINT_SIZE = 1000
+
+# Backgrounds used by the current worker process
+_backgrounds = None
+
+
+def process_images(backgrounds, output_path, delete_tmp=True, parallel=1, background_weights=None,
+                   background_memory=DEFAULT_MAX_MEMORY, background_mode="crop", crop_pool_size=10000,
+                   renderer=None, output_format="png", shard_size=1000, progress=None, seed=None, keep_alpha=False):
     """Processes rendered images.
 
-    Adds backgrounds and performs some simple transformations.
+    Adds backgrounds and performs some simple transformations. The rendered images are
+    split up into tasks which are processed concurrently by a pool of worker processes.
+
+    If a renderer is given, the images are processed while the renderer is still running.
+    Each image is processed as soon as it is completely written, so the temporary output
+    is deleted right away instead of piling up until the rendering is finished.
+
+    The processed images of each chunk are recorded in the progress file. Chunks that
+    are not completely rendered are skipped, so they can be rendered again first.
+
+    If the chunks contain label sidecars, the labels of the processed images are joined
+    into a sidecar of the whole dataset, see labels.LabelTable.
 
     Args:
         backgrounds: List of paths of images used as backgrounds for the final images.
         output_path: Where the rendered images are stored and will be stored to.
         delete_tmp: Whether we should delete the temporary output from rendering after
           the image processing is finished.
+        parallel: How many processes to start in parallel.
+        background_weights: How likely each background is to be used, in the order of
+          backgrounds. If None all backgrounds are used equally often.
+        background_memory: Maximum number of bytes the decoded backgrounds may take up.
+        background_mode: How background crops are created, see backgrounds.MODES.
+        crop_pool_size: How many background crops are created in advance in the "pool" mode.
+        renderer: The Renderer that is currently rendering the images, None if the
+          rendering is already finished.
+        output_format: How the processed images are stored; Options:
+          "png": Each image is stored as "<img_num>_<label>.png"
+          "tfrecord": The images are stored in TFRecord shards along with a manifest
+          "raw": The pixels of all images are stored in a single file that can be memory-mapped
+        shard_size: How many images are stored in a single shard.
+        progress: The Progress of the chunks, loaded from output_path if None.
+        seed: If given, each image is transformed with a seed derived from it and the number
+          of the image, so an image is processed the same way every time.
+        keep_alpha: Whether the rendered images are stored unchanged with their alpha channel,
+          without backgrounds and transformations, so they can be augmented during the training.
     """
 
     print("Starting processing")
     start = timer()
 
-    bg = cv2.imread(str(backgrounds[0]))
+    # the crop pool is created before any image is processed
+    if seed is not None:
+        random.seed(seed)
 
-    for tmp_dir in output_path.glob("tmp_*"):
-        run, count_per_run = _extract_dir_data(tmp_dir)
-        for img_path in tmp_dir.glob("*.png"):
+    # if the alpha channel is kept the backgrounds are only added during the training
+    bank = None
+    if not keep_alpha:
+        bank = BackgroundBank(backgrounds, weights=background_weights, max_memory=background_memory,
+                              mode=background_mode, pool_size=crop_pool_size)
+        bank.build()
 
-            hand_orig = cv2.imread(str(img_path), cv2.IMREAD_UNCHANGED)
+    if progress is None:
+        progress = Progress(output_path)
 
-            randomized_hand = _flip_and_rotate(hand_orig)
-            bg_crop = _get_random_background_crop(bg)
-            processed_image = _overlay(bg_crop, randomized_hand)
+    writer = create_writer(output_format, output_path, shard_size)
+    label_table = LabelTable(output_path)
 
-            num, open = _extract_img_data(img_path, run, count_per_run)
-            cv2.imwrite(str(output_path.joinpath("{}_{}.png".format(num, open))), processed_image)
+    process_task = partial(_process_task, output_path=output_path, output_format=output_format, seed=seed,
+                           keep_alpha=keep_alpha)
+
+    count = 0
+    written_tasks = []
+    written_count = 0
+
+    def finish(tasks):
+        """Records the images of tasks as processed and deletes them.
+
+        The progress is saved before the images are deleted, so an interrupted generation
+        never loses images that are not recorded as processed.
+        """
+
+        with progress.lock:
+            for _, img_paths in tasks:
+                progress.add_processed(img_paths[0].parent.name, len(img_paths))
+            progress.save()
 
             if delete_tmp:
-                os.remove(img_path)
+                for _, img_paths in tasks:
+                    for img_path in img_paths:
+                        os.remove(img_path)
+
+    def checkpoint():
+        """Stores the images, labels and progress written so far and finishes their tasks.
+        """
+
+        nonlocal written_count
+
+        if writer is not None:
+            writer.checkpoint()
+        label_table.checkpoint()
+
+        finish(written_tasks)
+        written_tasks.clear()
+        written_count = 0
+
+    def collect(task, samples):
+        """Handles the samples returned by a worker process.
+        """
+
+        nonlocal count, written_count
+        count += len(samples)
+
+        for num, label, img, labels in samples:
+            if writer is not None:
+                writer.write(num, label, img)
+            if labels is not None:
+                label_table.add(num, labels)
+
+        written_tasks.append(task)
+        written_count += len(samples)
+        if written_count >= CHECKPOINT_SIZE:
+            checkpoint()
+
+    try:
+        with ProcessPoolExecutor(parallel, initializer=_init_worker, initargs=(bank,)) as executor:
+            if renderer is None:
+                tasks = list(_create_tasks(output_path, progress=progress))
+                for task, samples in zip(tasks, executor.map(process_task, tasks)):
+                    collect(task, samples)
+            else:
+                _process_stream(executor, process_task, output_path, renderer, progress, collect)
+    finally:
+        if bank is not None:
+            bank.close()
+        if writer is not None:
+            writer.close()
+        label_table.close()
+
+        # images only count as processed once the writer and the labels are closed, until
+        # then they are kept so they can be processed again
+        finish(written_tasks)
 
     if delete_tmp:
+        # directories of chunks that still have to be rendered or processed are kept
         for tmp in output_path.glob("tmp*"):
             if tmp.is_dir():
-                os.rmdir(tmp)
+                if not any(path.name != LABELS_NAME for path in tmp.iterdir()):
+                    shutil.rmtree(tmp)
             else:
                 os.remove(tmp)
 
     end = timer()
     print("Image processing completed in {}s".format(end - start))
+    print("Processed {} images with {} processes ({:.1f} images/s)".format(count, parallel,
+                                                                         count / max(end - start, 1e-9)))
+
+
+def _process_stream(executor, process_task, output_path, renderer, progress, collect):
+    """Processes images as soon as they are rendered.
+
+    Looks for new images every POLL_INTERVAL seconds until the renderer is done.
+
+    Args:
+        executor: The executor running the worker processes.
+        process_task: The function processing a single task.
+        output_path: Where the rendered images are stored.
+        renderer: The Renderer that is rendering the images.
+        progress: The Progress of the chunks.
+        collect: Called with each task and its result.
+    """
+
+    submitted = set()
+    futures = {}
+
+    while True:
+        # checked before looking for images, so no image written afterwards can be missed
+        rendering_done = renderer.done.is_set()
+
+        for task in _create_tasks(output_path, renderer, submitted, progress):
+            submitted.update(task[1])
+            futures[executor.submit(process_task, task)] = task
+
+        # collect results early so errors in the workers surface right away
+        for future in [future for future in futures if future.done()]:
+            collect(futures.pop(future), future.result())
+
+        if rendering_done:
+            break
+
+        time.sleep(POLL_INTERVAL)
+
+    for future, task in futures.items():
+        collect(task, future.result())
 
 
-def _get_random_background_crop(img):
-    """Randomly crops an image to a 128x128 rectangle.
+def _create_tasks(output_path, renderer=None, submitted=(), progress=None):
+    """Splits up the rendered images into tasks for the worker processes.
 
     Args:
-        img: The image to crop.
+        output_path: Where the rendered images are stored.
+        renderer: The Renderer that is currently rendering the images, if given only
+          images that are completely written are included.
+        submitted: Images that are already part of a task and are skipped.
+        progress: The Progress of the chunks, if given finished chunks are only included
+          if they were completely rendered. Chunks it does not track are always included.
 
-    Returns: The cropped image.
+    Returns:
+        A generator of tuples (start, image paths), each containing at most MAX_PER_TASK
+        images of a single chunk.
+    """
+
+    for tmp_dir in sorted(output_path.glob("tmp_*")):
+        if not tmp_dir.is_dir():
+            continue
+
+        start, count = _extract_dir_data(tmp_dir)
+        finished = renderer is None or tmp_dir in renderer.finished_dirs
+        if finished and progress is not None and progress.get_state(tmp_dir.name) not in (None, RENDERED):
+            continue
+
+        img_paths = rendered_images(tmp_dir)
+
+        # blender writes the frames in order, while it is still running only the latest
+        # frame might be incomplete
+        if not finished and img_paths:
+            latest = max(img_paths, key=lambda path: _extract_img_data(path, start)[0])
+            img_paths.remove(latest)
+
+            # the sidecar is only written every few frames, images without labels yet are
+            # processed once it was written again
+            chunk_labels = read_chunk_labels(tmp_dir)
+            if chunk_labels is not None:
+                img_paths = [img_path for img_path in img_paths
+                             if _extract_img_data(img_path, start)[0] - start in chunk_labels]
+
+        img_paths = [img_path for img_path in img_paths if img_path not in submitted]
+        for i in range(0, len(img_paths), MAX_PER_TASK):
+            yield start, img_paths[i:i + MAX_PER_TASK]
+
+
+def _init_worker(backgrounds):
+    """Initializes a worker process.
+
+    Args:
+        backgrounds: The BackgroundBank to sample backgrounds from.
     """
 
-    # crop and scale
-    height, width, channels = img.shape
-    min_dim = min(height, width) / 4
+    global _backgrounds
+
+    # forked processes share the random state of the parent, without reseeding all
+    # workers would apply the same transformations
+    random.seed()
 
-    # dont crop smaller than target size
-    scaled_size = max(int(random.random() * min_dim), 128)
+    _backgrounds = backgrounds
 
-    left = random.randint(0, width - scaled_size)
-    up = random.randint(0, height - scaled_size)
 
-    img = img[up:up + scaled_size, left:left + scaled_size]
-    img = cv2.resize(img, (128, 128))
+def _process_task(task, output_path, output_format="png", seed=None, keep_alpha=False):
+    """Processes a single task in a worker process.
+
+    Args:
+        task: Tuple of (start, image paths) as created by _create_tasks.
+        output_path: Where the processed images will be stored to.
+        output_format: If "png" the images are stored, otherwise they are returned encoded
+          as .png for "tfrecord" or as arrays for "raw".
+        seed: The seed of the dataset, None to not seed the transformations.
+        keep_alpha: Whether the rendered images are stored unchanged with their alpha channel.
+
+    Returns:
+        A list of (num, label, image, labels) tuples, the image is None if it was stored,
+        labels is a dict of the labels from the sidecar of the chunk or None if it has none.
+    """
+
+    start, img_paths = task
+    chunk_labels = read_chunk_labels(img_paths[0].parent)
+
+    if keep_alpha:
+        processed_images = [_to_bgra(read_rendered_image(img_path)) for img_path in img_paths]
+    else:
+        hands = []
+        bg_crops = []
+        for img_path in img_paths:
+            # seeding each image on its own makes it independent of the task it ended up in
+            if seed is not None:
+                random.seed("{}_{}".format(seed, _extract_img_data(img_path, start)[0]))
+
+            hands.append(_flip_and_rotate(read_rendered_image(img_path)))
+            bg_crops.append(_backgrounds.sample_crop())
+
+        processed_images = _overlay_batch(np.stack(bg_crops), np.stack(hands))
+
+    samples = []
+    for img_path, processed_image in zip(img_paths, processed_images):
+        num, open = _extract_img_data(img_path, start)
+        labels = chunk_labels.get(num - start) if chunk_labels is not None else None
+
+        if output_format == "tfrecord":
+            samples.append((num, open, cv2.imencode(".png", processed_image)[1].tobytes(), labels))
+        elif output_format == "raw":
+            # opencv uses BGR, the raw images are read as they are, so they are stored as RGB
+            code = cv2.COLOR_BGRA2RGBA if keep_alpha else cv2.COLOR_BGR2RGB
+            samples.append((num, open, cv2.cvtColor(processed_image, code), labels))
+        else:
+            cv2.imwrite(str(output_path.joinpath("{}_{}.png".format(num, open))), processed_image)
+            samples.append((num, open, None, labels))
+
+    return samples
+
+
+def _to_bgra(img):
+    """Adds an opaque alpha channel to images rendered without one.
+    """
+
+    if img.shape[2] == 3:
+        return cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
 
     return img
 
@@ -127,44 +397,48 @@ def _translate(img):
     return img
 
 
-def _overlay(img, overlay_img):
-    """Overlays an image over another image.
+def _overlay_batch(imgs, overlay_imgs):
+    """Overlays a batch of images over a batch of other images.
+
+    The alpha blending is done in a single vectorized pass using integer arithmetic,
+    the result is written into the background images in place.
 
     Args:
-        img: The background image.
-        overlay_img: The image being put on top.
+        imgs: The background images, an uint8 array of shape (N, height, width, 3).
+        overlay_imgs: The images being put on top, an uint8 array of shape (N, height, width, 4).
 
-    Returns: The background image with the overlay.
+    Returns: The background images with the overlays.
     """
 
-    alpha_overlay = overlay_img[:, :, 3] / 255.0
-    alpha_img = 1.0 - alpha_overlay
+    alpha = overlay_imgs[..., 3:].astype(np.uint16)
 
-    for c in range(0, 3):
-        img[:, :, c] = (alpha_overlay * overlay_img[:, :, c] +
-                        alpha_img * img[:, :, c])
+    # 255 * 255 + 127 still fits into 16 bits, so no intermediate value can overflow
+    blended = overlay_imgs[..., :3] * alpha
+    blended += imgs * (255 - alpha)
+    blended += 127
+    blended //= 255
 
-    return img
+    imgs[...] = blended
+    return imgs
 
 
-def _extract_img_data(path, run, count_per_run):
+def _extract_img_data(path, start):
     """
 
-    Expects the image name to be encoded like: "<img_num>_<label>.png".
-    Calculates the number of this image across all runs.
+    Expects the image name to be encoded like: "<label>_<frame>.png".
+    Calculates the number of this image across all chunks.
 
     Args:
         path: Path of the image.
-        run: In which run index this image was rendered.
-        count_per_run: How many images are rendered per run.
+        start: The number of the first image of the chunk this image was rendered in.
 
     Returns:
-        The number of this image across all runs and the corresponding label.
+        The number of this image across all chunks and the corresponding label.
     """
 
     split = path.stem.split("_")
     num = int(split[1])
-    num = run * count_per_run + num
+    num = start + num
 
     label = int(split[0])
 
@@ -174,17 +448,17 @@ def _extract_img_data(path, run, count_per_run):
 def _extract_dir_data(path):
     """
 
-    Expects the directory to be named like: "tmp_<run>_with_<images in run>"
+    Expects the directory to be named like: "tmp_<first image number>_with_<images in chunk>"
 
     Args:
         path: Path of the directory.
 
     Returns:
-        The run index and image count per run.
+        The number of the first image and the image count of the chunk.
     """
 
     split = path.stem.split("_")
-    run = int(split[1])
-    count_per_run = int(split[3])
+    start = int(split[1])
+    count = int(split[3])
 
-    return run, count_per_run
+    return start, count
@@ -0,0 +1,178 @@
+import json
+import os
+import threading
+import zlib
+
+from pose_detector.generation.images import rendered_images
+
+PROGRESS_NAME = "progress.json"
+
+# States of a render chunk
+PENDING = "pending"
+RENDERING = "rendering"
+RENDERED = "rendered"
+PROCESSED = "processed"
+FAILED = "failed"
+
+
+class Progress:
+    """Tracks the state of each render chunk in a file in the output directory.
+
+    Each chunk is identified by the name of its temporary output directory and moves
+    through the states pending, rendering, rendered and processed, or ends up as failed
+    if it could not be rendered. Along with the state
+    the number of rendered and processed images and a checksum of the rendered images
+    are stored. The file is rewritten after every change of a state, so an interrupted
+    generation can continue where it stopped. Processed images are only counted in
+    memory, the processing saves them at its checkpoints.
+
+    Attributes:
+        path: Location of the progress file.
+        plan: The dataset size and the range of image numbers assigned to each model,
+          None if the generation has not started yet.
+        chunks: Mapping of chunk names to their state.
+        lock: Held while the progress is changed, can be held by callers to change the
+          progress along with the images of a chunk.
+    """
+
+    def __init__(self, output_path):
+        self.path = output_path.joinpath(PROGRESS_NAME)
+        self.plan = None
+        self.chunks = {}
+
+        self.lock = threading.RLock()
+
+        if self.path.exists():
+            with open(self.path) as f:
+                data = json.load(f)
+
+            self.plan = data.get("plan")
+            self.chunks = data["chunks"]
+
+    def add(self, name, model, count, start):
+        """Adds a chunk in the pending state, unless it is already tracked.
+
+        Args:
+            name: The name of the temporary output directory of the chunk.
+            model: The path of the model rendered in this chunk.
+            count: How many images the chunk should contain.
+            start: The number of the first image of the chunk.
+        """
+
+        with self.lock:
+            if name not in self.chunks:
+                self.chunks[name] = {
+                    "state": PENDING,
+                    "model": model,
+                    "count": count,
+                    "start": start,
+                    "rendered": 0,
+                    "processed": 0,
+                    "checksum": None,
+                }
+                self.save()
+
+    def remove(self, name):
+        """Stops tracking a chunk.
+        """
+
+        with self.lock:
+            del self.chunks[name]
+            self.save()
+
+    def get_state(self, name):
+        """Returns the state of a chunk, None if it is not tracked.
+        """
+
+        with self.lock:
+            if name not in self.chunks:
+                return None
+
+            return self.chunks[name]["state"]
+
+    def set_state(self, name, state, **values):
+        """Changes the state of a chunk.
+
+        Args:
+            name: The name of the chunk.
+            state: The new state.
+            values: Other values of the chunk to change.
+        """
+
+        with self.lock:
+            self.chunks[name].update(values, state=state)
+            self.save()
+
+    def add_processed(self, name, count):
+        """Records that images of a chunk were processed.
+
+        The chunk is processed once all of its rendered images are. The file is not
+        rewritten, so the caller has to save it once it processed a batch of images.
+
+        Args:
+            name: The name of the chunk.
+            count: How many images were processed.
+        """
+
+        with self.lock:
+            if name not in self.chunks:
+                return
+
+            chunk = self.chunks[name]
+            chunk["processed"] += count
+            if chunk["state"] == RENDERED and chunk["processed"] >= chunk["rendered"]:
+                chunk["state"] = PROCESSED
+
+    def verify(self, name, tmp_dir):
+        """Checks if the rendered images of a chunk are still complete and unchanged.
+
+        Only chunks whose images were not partially processed can be verified, others are
+        assumed to be intact.
+
+        Args:
+            name: The name of the chunk.
+            tmp_dir: The temporary output directory of the chunk.
+
+        Returns:
+            False if images are missing or were modified.
+        """
+
+        with self.lock:
+            chunk = self.chunks[name]
+            if chunk["processed"] > 0:
+                return True
+
+            count, checksum = compute_checksum(tmp_dir)
+            return count == chunk["rendered"] and checksum == chunk["checksum"]
+
+    def save(self):
+        """Writes the progress file.
+
+        The file is replaced atomically, so it is never left partially written.
+        """
+
+        with self.lock:
+            tmp_path = self.path.with_name(self.path.name + ".part")
+            with open(tmp_path, "w") as f:
+                json.dump({"plan": self.plan, "chunks": self.chunks}, f)
+            os.replace(tmp_path, self.path)
+
+
+def compute_checksum(tmp_dir):
+    """Computes a checksum over all rendered images in a directory.
+
+    Args:
+        tmp_dir: The directory containing the images.
+
+    Returns:
+        The number of images and the checksum.
+    """
+
+    count = 0
+    checksum = 0
+    for img_path in rendered_images(tmp_dir):
+        with open(img_path, "rb") as f:
+            checksum = zlib.crc32(img_path.name.encode() + f.read(), checksum)
+        count += 1
+
+    return count, checksum
@@ -0,0 +1,367 @@
+import json
+import os
+
+import numpy as np
+
+from pose_detector.generation.labels import join_labels
+
+# tensorflow is only imported by the functions that need it, the processing imports this
+# module in every worker process and most formats do not need it
+
+MANIFEST_NAME = "manifest.json"
+
+# Numbers of the images in the shards, in the order they were written
+SHARD_NUMS_NAME = "shard-nums.npy"
+
+# How many shards are read at the same time, consecutive images are taken from different ones
+SHARD_CYCLE_LENGTH = 8
+
+# Files of the raw format
+RAW_HEADER_NAME = "header.json"
+RAW_IMAGES_NAME = "images.u8"
+RAW_LABELS_NAME = "labels.npy"
+RAW_NUMS_NAME = "nums.npy"
+
+
+
+class ShardWriter:
+    """Writes processed images into TFRecord shards of a fixed size.
+
+    Once all images are written, a manifest describing the shards and the labels is
+    stored next to them. If the directory already contains a manifest, new images are
+    written to additional shards, so an interrupted generation can be continued.
+
+    Attributes:
+        output_path: Directory where the shards will be stored.
+        shard_size: How many images are stored in a single shard.
+        shards: The name and image count of each written shard.
+        labels: The labels of all written images.
+        nums: The numbers of all written images across all runs.
+    """
+
+    def __init__(self, output_path, shard_size=1000):
+        self.output_path = output_path
+        self.shard_size = shard_size
+        self.shards = []
+        self.labels = []
+        self.nums = []
+
+        self._writer = None
+
+        if has_shards(output_path):
+            with open(output_path.joinpath(MANIFEST_NAME)) as f:
+                manifest = json.load(f)
+
+            self.shards = manifest["shards"]
+            for value, count in manifest["labels"]["histogram"].items():
+                self.labels += [int(value)] * count
+            self.nums = _read_shard_nums(output_path, manifest).tolist()
+
+    def write(self, num, label, encoded_img):
+        """Writes a single image to the current shard.
+
+        Args:
+            num: The number of the image across all runs.
+            label: The label of the image.
+            encoded_img: The image encoded as .png.
+        """
+
+        import tensorflow as tf
+
+        if self._writer is None:
+            name = "shard-{:05d}.tfrecord".format(len(self.shards))
+            self._writer = tf.io.TFRecordWriter(str(self.output_path.joinpath(name)))
+            self.shards.append({"name": name, "count": 0})
+
+        example = tf.train.Example(features=tf.train.Features(feature={
+            "image": tf.train.Feature(bytes_list=tf.train.BytesList(value=[encoded_img])),
+            "label": tf.train.Feature(int64_list=tf.train.Int64List(value=[label])),
+            "num": tf.train.Feature(int64_list=tf.train.Int64List(value=[num])),
+        }))
+        self._writer.write(example.SerializeToString())
+
+        self.shards[-1]["count"] += 1
+        self.labels.append(label)
+        self.nums.append(num)
+
+        if self.shards[-1]["count"] >= self.shard_size:
+            self._writer.close()
+            self._writer = None
+
+    def checkpoint(self):
+        """Closes the current shard and writes the manifest, so all images written so far are
+        stored. The next image starts a new shard.
+        """
+
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+        np.save(str(self.output_path.joinpath(SHARD_NUMS_NAME)), np.array(self.nums, dtype=np.int64))
+
+        labels = np.array(self.labels)
+        values, counts = np.unique(labels, return_counts=True)
+        manifest = {
+            "format": "tfrecord",
+            "count": len(self.labels),
+            "shard_size": self.shard_size,
+            "shards": self.shards,
+            "nums": SHARD_NUMS_NAME,
+            "labels": {
+                "min": int(labels.min()) if len(labels) else None,
+                "max": int(labels.max()) if len(labels) else None,
+                "mean": float(labels.mean()) if len(labels) else None,
+                "std": float(labels.std()) if len(labels) else None,
+                "histogram": {str(value): int(count) for value, count in zip(values, counts)},
+            },
+        }
+
+        _write_json(self.output_path.joinpath(MANIFEST_NAME), manifest)
+
+    def close(self):
+        """Closes the current shard and writes the manifest.
+        """
+
+        self.checkpoint()
+
+
+class RawWriter:
+    """Writes processed images into a single file of raw uint8 pixels.
+
+    The file can be memory-mapped as an array of shape (count, height, width, 3), so the
+    images can be read without decoding them. The labels and the numbers of the images
+    are stored in separate arrays and a small header describes the array. If the directory
+    already contains a header, new images are appended to the existing ones.
+
+    Attributes:
+        output_path: Directory where the files will be stored.
+        shape: The shape of a single image.
+        labels: The labels of all written images.
+        nums: The numbers of all written images across all runs.
+    """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.shape = None
+        self.labels = []
+        self.nums = []
+
+        images_path = output_path.joinpath(RAW_IMAGES_NAME)
+        if has_raw(output_path):
+            with open(output_path.joinpath(RAW_HEADER_NAME)) as f:
+                header = json.load(f)
+
+            self.shape = tuple(header["shape"]) if header["shape"] is not None else None
+            self.labels = np.load(str(output_path.joinpath(header["labels"]))).tolist()
+            self.nums = np.load(str(output_path.joinpath(header["nums"]))).tolist()
+
+            # drop images written after the header was last stored
+            self._file = open(images_path, "r+b")
+            self._file.truncate(len(self.labels) * int(np.prod(self.shape or 0)))
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self._file = open(images_path, "wb")
+
+    def write(self, num, label, img):
+        """Appends a single image to the file.
+
+        Args:
+            num: The number of the image across all runs.
+            label: The label of the image.
+            img: The image, an uint8 array of shape (height, width, 3).
+        """
+
+        if self.shape is None:
+            self.shape = img.shape
+        elif img.shape != self.shape:
+            raise ValueError("Image {} has shape {}, expected {}".format(num, img.shape, self.shape))
+
+        self._file.write(np.ascontiguousarray(img, dtype=np.uint8).tobytes())
+        self.labels.append(label)
+        self.nums.append(num)
+
+    def checkpoint(self):
+        """Flushes the file and writes the labels and the header, so all images written so far
+        are stored.
+        """
+
+        self._file.flush()
+
+        np.save(str(self.output_path.joinpath(RAW_LABELS_NAME)), np.array(self.labels, dtype=np.int32))
+        np.save(str(self.output_path.joinpath(RAW_NUMS_NAME)), np.array(self.nums, dtype=np.int64))
+
+        header = {
+            "format": "raw",
+            "count": len(self.labels),
+            "shape": list(self.shape) if self.shape is not None else None,
+            "dtype": "uint8",
+            "images": RAW_IMAGES_NAME,
+            "labels": RAW_LABELS_NAME,
+            "nums": RAW_NUMS_NAME,
+        }
+
+        _write_json(self.output_path.joinpath(RAW_HEADER_NAME), header)
+
+    def close(self):
+        """Closes the file and writes the labels and the header.
+        """
+
+        self.checkpoint()
+        self._file.close()
+
+
+def create_writer(output_format, output_path, shard_size=1000):
+    """Creates the writer storing the processed images.
+
+    Args:
+        output_format: One of "png", "tfrecord" or "raw".
+        output_path: Directory where the images will be stored.
+        shard_size: How many images are stored in a single TFRecord shard.
+
+    Returns:
+        A ShardWriter or RawWriter, None if each image is stored as a separate file.
+    """
+
+    if output_format == "tfrecord":
+        return ShardWriter(output_path, shard_size)
+    elif output_format == "raw":
+        return RawWriter(output_path)
+    elif output_format == "png":
+        return None
+
+    raise ValueError("Unknown output format {}".format(output_format))
+
+
+def has_raw(data_dir):
+    """Whether a dataset directory contains images written by a RawWriter.
+    """
+
+    return data_dir.joinpath(RAW_HEADER_NAME).exists()
+
+
+def read_raw(data_dir, targets=None):
+    """Memory-maps the images written by a RawWriter.
+
+    Args:
+        data_dir: The directory containing the raw files and the header.
+        targets: The names of the labels to read from the label sidecar, see labels.join_labels.
+          If None the labels the images were written with are used.
+
+    Returns:
+        A read-only memory-mapped array of all images, an array of their labels and an
+        array of their numbers.
+    """
+
+    with open(data_dir.joinpath(RAW_HEADER_NAME)) as f:
+        header = json.load(f)
+
+    nums = np.load(str(data_dir.joinpath(header["nums"])))
+    if targets is None:
+        labels = np.load(str(data_dir.joinpath(header["labels"])))
+    else:
+        labels = join_labels(data_dir, nums, targets)
+    images = np.memmap(str(data_dir.joinpath(header["images"])), dtype=header["dtype"], mode="r",
+                       shape=tuple([header["count"]] + header["shape"]))
+
+    return images, labels, nums
+
+
+def has_shards(data_dir):
+    """Whether a dataset directory contains shards written by a ShardWriter.
+    """
+
+    return data_dir.joinpath(MANIFEST_NAME).exists()
+
+
+def read_shards(data_dir, targets=None, shuffle=False):
+    """Reads the images stored in the shards of a dataset directory.
+
+    SHARD_CYCLE_LENGTH shards are read at the same time, taking one image of each in turn.
+
+    Args:
+        data_dir: The directory containing the shards and the manifest.
+        targets: The names of the labels to read from the label sidecar, see labels.join_labels.
+          If None the labels the images were written with are used.
+        shuffle: Whether the shards are read in a random order, which changes each iteration.
+
+    Returns:
+        A dataset of (encoded image, label, num) tuples and the number of images.
+    """
+
+    import tensorflow as tf
+
+    with open(data_dir.joinpath(MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+
+    paths = [str(data_dir.joinpath(shard["name"])) for shard in manifest["shards"]]
+    ds = tf.data.Dataset.from_tensor_slices(paths)
+    if shuffle:
+        # the images of a shard come from a few chunks of the same model, so the order of the
+        # shards is shuffled and consecutive images are taken from different shards
+        ds = ds.shuffle(buffer_size=len(paths), reshuffle_each_iteration=True)
+    ds = ds.interleave(tf.data.TFRecordDataset, cycle_length=max(min(SHARD_CYCLE_LENGTH, len(paths)), 1),
+                       num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    ds = ds.map(_parse_example, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    if targets is not None:
+        # the labels of all images are looked up before reading any of them, so images
+        # missing from the sidecar raise the same error as for the other formats
+        nums = np.unique(_read_shard_nums(data_dir, manifest))
+        values = tf.constant(join_labels(data_dir, nums, targets))
+        rows = tf.lookup.StaticHashTable(
+            tf.lookup.KeyValueTensorInitializer(tf.constant(nums, dtype=tf.int64),
+                                                tf.range(len(nums), dtype=tf.int64)), default_value=-1)
+        ds = ds.map(lambda img, label, num: (img, tf.gather(values, rows.lookup(num)), num),
+                    num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    return ds, manifest["count"]
+
+
+def _read_shard_nums(data_dir, manifest):
+    """Returns the numbers of the images in the shards, in the order they were written.
+
+    Manifests written before the numbers were stored next to them have no "nums", the
+    numbers are then read from the shards themselves.
+    """
+
+    if "nums" in manifest:
+        return np.load(str(data_dir.joinpath(manifest["nums"])))
+
+    import tensorflow as tf
+
+    paths = [str(data_dir.joinpath(shard["name"])) for shard in manifest["shards"]]
+    ds = tf.data.TFRecordDataset(paths).map(lambda example: tf.io.parse_single_example(example, _features())["num"])
+    return np.fromiter(ds.as_numpy_iterator(), dtype=np.int64)
+
+
+def _write_json(path, data):
+    """Writes a json file atomically, so a checkpoint that is interrupted keeps the previous one.
+    """
+
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _parse_example(serialized):
+    """Parses a serialized image into a tuple of (encoded image, label, num).
+    """
+
+    import tensorflow as tf
+
+    example = tf.io.parse_single_example(serialized, _features())
+    return example["image"], tf.cast(example["label"], tf.int32), example["num"]
+
+
+def _features():
+    """Returns the features stored for each image in the shards.
+    """
+
+    import tensorflow as tf
+
+    return {
+        "image": tf.io.FixedLenFeature([], tf.string),
+        "label": tf.io.FixedLenFeature([], tf.int64),
+        "num": tf.io.FixedLenFeature([], tf.int64),
+    }
@@ -1,10 +1,25 @@
+import hashlib
+import json
+import os
 import pathlib
-from concurrent.futures.process import ProcessPoolExecutor
-from math import ceil
+import random
+import shutil
+import threading
+from collections import deque
+from concurrent.futures.thread import ThreadPoolExecutor
 from timeit import default_timer as timer
 import subprocess
+import time
 
-MAX_PER_PROCESS = 2000
+from pose_detector.generation.devices import assign_devices
+from pose_detector.generation.images import rendered_images
+from pose_detector.generation.labels import read_chunk_labels
+from pose_detector.generation.progress import Progress, RENDERING, RENDERED, PROCESSED, FAILED, compute_checksum
+from pose_detector.generation.scheduling import SEEDED_CHUNK_SIZE, Scheduler
+from pose_detector.generation.telemetry import RenderMonitor, parse_event
+
+# How many lines of the output of a render worker are kept to report failures
+OUTPUT_LINES = 50
 
 
 class Renderer:
@@ -20,70 +35,502 @@ class Renderer:
         parallel: How many processes to start in parallel.
         blender_path: Location of the directory containing the blender executable.
         blenderproc_run_path: Location of the blenderproc python script used as the entry point.
+        progress: Tracks the state of each chunk across interrupted generations.
+        fresh_processes: Whether each chunk is rendered by a new Blenderproc process instead
+          of keeping the processes running between chunks.
+        retries: How often the images of a failed chunk are rendered again.
+        seed: The seed the seeds of all chunks are derived from, None to seed them randomly.
+        devices: The devices the workers are distributed over, see devices.parse_devices.
+          If None every worker uses all GPUs.
+        cpu_threads: How many threads each worker rendering on the CPU uses.
+        coordinator: The farm.Coordinator handing out the chunks to remote render nodes,
+          None to render with local processes.
+        monitor: The RenderMonitor of the current rendering, None before it started.
+        failed: The names of the chunks that failed permanently.
+        finished_dirs: The temporary output directories of all chunks that are finished.
+        done: Set once the rendering is finished.
     """
 
-    def __init__(self, count, config_path, model_paths, output_path, parallel=1):
+    def __init__(self, count, config_path, model_paths, output_path, parallel=1, progress=None,
+                 fresh_processes=False, retries=2, seed=None, devices=None, cpu_threads=None, coordinator=None):
         self.count = count
         self.config_path = config_path
         self.model_paths = model_paths
         self.output_path = output_path
         self.parallel = parallel
+        self.progress = progress if progress is not None else Progress(output_path)
+        self.fresh_processes = fresh_processes
+        self.retries = retries
+        self.seed = seed
+        self.devices = devices
+        self.cpu_threads = cpu_threads
+        self.coordinator = coordinator
 
         root = _get_root_path()
         self.blender_path = root.joinpath("tools/blender")
         self.blenderproc_run_path = root.joinpath("tools/BlenderProc/run.py")
 
+        self.monitor = None
+        self.failed = []
+        self.finished_dirs = set()
+        self.done = threading.Event()
+
     def render(self):
         """Starts the rendering procedure.
 
-        Splits up work into multiple chunks to reduce the Blenderproc overhead by limiting the maximum
-        number of images a process might render.
+        Splits up work into chunks that are handed out to the workers by a Scheduler. Each
+        worker renders its chunks with a RenderWorker, a Blenderproc process that stays
+        running between chunks. The chunks are sized from the measured startup overhead and
+        render times, so all workers finish together. Exactly count images are rendered.
+
+        If a seed is set, the chunks instead cover fixed cells of SEEDED_CHUNK_SIZE image
+        numbers, so every run renders the same chunks and the same poses, see _chunk_seed.
+
+        The state of each chunk is tracked in the progress file, chunks that were already
+        rendered by a previous, interrupted generation are skipped. Chunks that were still
+        rendering or whose images were modified since are rendered again.
+
+        The progress is printed regularly and a report of the timings of all chunks is
+        written to the output directory once the rendering is finished.
+
+        If a coordinator is set, the chunks are rendered by the nodes connecting to it
+        instead of local processes.
         """
 
         print("Starting rendering")
         start = timer()
 
-        run_index = 0
-
-        # Blenderproc has overhead that scales with the number of images rendered
-        # to avoid too long rendering times we cap the amount of rendered images
-        # per process
-        per_model = self.count // len(self.model_paths)
-        iterations = ceil(per_model / MAX_PER_PROCESS)
-        iterations = max(iterations, self.parallel // len(self.model_paths))  # force small datasets to parallelize
-        per_iteration = per_model // iterations
+        ranges = self._plan_ranges()
+        scheduler = Scheduler(ranges, self.parallel, grid=SEEDED_CHUNK_SIZE if self.seed is not None else None)
+        remaining = sum(end - begin for model_ranges in ranges.values() for begin, end in model_ranges)
+        self.monitor = RenderMonitor(remaining, self.output_path)
 
-        with ProcessPoolExecutor(self.parallel) as executor:
-            for i in range(iterations):
-                for model_path in self.model_paths:
-                    executor.submit(self._start_render_process, run_index, str(model_path), per_iteration)
-                    run_index += 1
+        # each run is a separate blender process, so threads suffice to run them in parallel
+        try:
+            if self.coordinator is not None:
+                self.coordinator.serve(scheduler, lambda worker: self._work(scheduler, worker=worker))
+            else:
+                with ThreadPoolExecutor(self.parallel) as executor:
+                    envs = assign_devices(self.devices, self.parallel, self.cpu_threads)
+                    futures = [executor.submit(self._work, scheduler, env) for env in envs]
+                    for future in futures:
+                        future.result()
+        finally:
+            self.monitor.write_report(self.failed)
+            self.done.set()
 
         end = timer()
         print("Rendering completed in {}s".format(end - start))
 
-    def _start_render_process(self, run_index, model_path, per_iteration):
-        """Starts a single rendering process.
+        if self.failed:
+            missing = sum(self.progress.chunks[name]["count"] for name in self.failed)
+            print("{} chunks with {} images failed permanently, run the same command again to retry them".format(
+                len(self.failed), missing))
+
+    def _plan_ranges(self):
+        """Assigns a range of image numbers to each model.
+
+        The images are split up evenly between the models. If the progress file already
+        contains a plan it is reused, images of chunks that are already rendered are left out.
+
+        Returns:
+            For each model the ranges (start, end) of image numbers that still have to be
+            rendered.
+        """
+
+        plan = {"size": self.count, "models": {}}
+        start = 0
+        for i, model_path in enumerate(sorted(self.model_paths)):
+            count = self.count // len(self.model_paths) + (1 if i < self.count % len(self.model_paths) else 0)
+            plan["models"][str(model_path)] = [start, start + count]
+            start += count
+
+        if self.progress.plan is None:
+            with self.progress.lock:
+                self.progress.plan = plan
+                self.progress.save()
+        elif self.progress.plan != plan:
+            raise ValueError("{} belongs to a generation with a different size or different models"
+                             .format(self.progress.path))
+        elif self.progress.chunks:
+            print("Resuming {} chunks from {}".format(len(self.progress.chunks), self.progress.path))
+
+        rendered = {model: [] for model in plan["models"]}
+        for name, chunk in list(self.progress.chunks.items()):
+            tmp_dir = self.output_path.joinpath(name)
+            if self._needs_rendering(name, tmp_dir):
+                self.progress.remove(name)
+                if tmp_dir.exists():
+                    shutil.rmtree(tmp_dir)
+            else:
+                rendered[chunk["model"]].append((chunk["start"], chunk["start"] + chunk["count"]))
+                self.finished_dirs.add(tmp_dir)
+
+        ranges = {}
+        for model, (start, end) in plan["models"].items():
+            ranges[model] = []
+            for chunk_start, chunk_end in sorted(rendered[model]):
+                if chunk_start > start:
+                    ranges[model].append((start, chunk_start))
+                start = chunk_end
+            if end > start:
+                ranges[model].append((start, end))
+
+        return ranges
+
+    def _needs_rendering(self, name, tmp_dir):
+        """Whether a chunk has to be rendered.
+
+        Args:
+            name: The name of the chunk.
+            tmp_dir: The temporary output directory of the chunk.
+
+        Returns:
+            False if the chunk is already processed or completely rendered.
+        """
+
+        state = self.progress.get_state(name)
+        if state == PROCESSED:
+            return False
+
+        if state == RENDERED:
+            if self.progress.verify(name, tmp_dir):
+                return False
+
+            print("Images of {} are missing or corrupt, rendering it again".format(name))
+
+        return True
+
+    def _work(self, scheduler, env=None, worker=None):
+        """Renders chunks taken from the scheduler until all images are assigned.
+
+        If a chunk fails, its completely written images are kept and the remaining ones are
+        rendered again by a new process with a fresh seed, at most retries times. If the
+        worker is lost, the remaining images are put back into the queue instead.
 
         Args:
-            run_index: The index of this chunk of data that is being generated.
+            scheduler: The Scheduler handing out the chunks.
+            env: The environment of the Blenderproc processes, selecting their device.
+            worker: The worker to render with, a local RenderWorker is created if None.
+              Other workers wait for the chunks of lost workers until all are rendered.
+        """
+
+        wait = worker is not None
+        if worker is None:
+            worker = RenderWorker(self.blenderproc_run_path, self.config_path, self.blender_path, env)
+
+        try:
+            while True:
+                chunk = scheduler.next_chunk(wait)
+                if chunk is None:
+                    return
+
+                model_path, start, count = chunk
+                try:
+                    for attempt in range(self.retries + 1):
+                        if attempt > 0:
+                            print("Retrying the remaining {} images (attempt {} of {})".format(count, attempt + 1,
+                                                                                               self.retries + 1))
+
+                        tmp_dir = self.output_path.joinpath("tmp_{}_with_{}".format(start, count))
+                        self.progress.add(tmp_dir.name, model_path, count, start)
+
+                        try:
+                            rendered = self._render_chunk(worker, scheduler, start, tmp_dir, model_path, count,
+                                                          attempt)
+                        finally:
+                            self.finished_dirs.add(tmp_dir)
+
+                        if self.fresh_processes:
+                            worker.close()
+
+                        if rendered == count:
+                            count = 0
+                            break
+
+                        start, count = start + rendered, count - rendered
+
+                        # the remaining images are left to the other workers
+                        if worker.lost:
+                            break
+                    else:
+                        self._fail_chunk(model_path, start, count)
+                        count = 0
+                finally:
+                    scheduler.release(model_path, start, count if worker.lost else 0)
+
+                if worker.lost:
+                    return
+        finally:
+            worker.close()
+
+    def _render_chunk(self, worker, scheduler, start, tmp_dir, model_path, count, attempt=0):
+        """Renders a single chunk and records its state.
+
+        A chunk is only rendered if the process reported no error and both the process and
+        the output directory contain all frames. Otherwise the chunk is shortened to the
+        images that were completely written.
+
+        Args:
+            worker: The RenderWorker used for rendering.
+            scheduler: The Scheduler the timings of the chunk are reported to.
+            start: The number of the first image of this chunk.
+            tmp_dir: The directory the rendered images of this chunk are written to.
             model_path: The model to use for rendering this chunk.
-            per_iteration: How many images should be rendered.
+            count: How many images should be rendered.
+            attempt: How often rendering these images failed before.
+
+        Returns:
+            How many images of the chunk were rendered.
         """
 
-        print("Starting run {}".format(run_index))
-
-        tmp_dir = self.output_path.joinpath("tmp_{}_with_{}".format(run_index, per_iteration))
-        p = subprocess.Popen(
-            ["python", self.blenderproc_run_path,
-             self.config_path,       # config
-             self.blender_path,      # blender install location
-             tmp_dir,                # temporary output directory
-             model_path]             # .blend model to use
-            + [str(per_iteration)],  # count to render
-            stdout=subprocess.DEVNULL
-        )
-        p.wait()
+        name = tmp_dir.name
+
+        # images left over by an interrupted run might be incomplete
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+
+        seed = self._chunk_seed(model_path, start, attempt)
+        self.progress.set_state(name, RENDERING, rendered=0, processed=0, checksum=None, seed=seed)
+        self.monitor.start_chunk(name, model_path, count)
+
+        print("Starting run {} with {} images of {}".format(start, count, pathlib.Path(model_path).stem))
+        started = time.time()
+        report = worker.render(tmp_dir, model_path, count, seed,
+                               on_event=lambda event: self.monitor.handle(name, event))
+        ended = time.time()
+
+        # while streaming, processed images might already be deleted
+        with self.progress.lock:
+            rendered, checksum = compute_checksum(tmp_dir)
+            rendered += self.progress.chunks[name]["processed"]
+
+        if report is None and worker.lost:
+            status = "lost the connection to the worker"
+        elif report is None:
+            status = "exited with code {}".format(worker.returncode)
+        elif report["status"] != "done":
+            status = report["status"]
+        elif report["frames"] != count or rendered != count:
+            status = "rendered only {} of {} images".format(min(report["frames"], rendered), count)
+        else:
+            status = "done"
+
+        # the first frame is written once blender started and rendered it, the time between
+        # the first and the last frame is spent rendering the remaining ones
+        first_frame = report["first_frame"] if report is not None else None
+        if first_frame is not None and count > 1:
+            frame_time = (ended - first_frame) / (count - 1)
+            overhead = max(first_frame - started - frame_time, 0)
+        else:
+            frame_time = (ended - started) / max(count, 1)
+            overhead = None
+
+        if status == "done":
+            self.progress.set_state(name, RENDERED, rendered=rendered, checksum=checksum)
+            self.monitor.finish_chunk(name, status, overhead, frame_time)
+            scheduler.record(model_path, count, overhead, frame_time)
+            return count
+
+        print("{} failed: {}".format(name, status))
+        self.monitor.finish_chunk(name, status, overhead, frame_time, output=list(worker.output))
+
+        # the process might be left in any state
+        worker.close()
+
+        return self._truncate_chunk(name, tmp_dir, min(self.monitor.chunks[name]["frames"], rendered))
+
+    def _chunk_seed(self, model_path, start, attempt):
+        """Returns the seed used for rendering a chunk.
+
+        The seed is derived from the seed of the renderer, the model, the first image and
+        the attempt, so every chunk and retry gets a distinct seed that is the same every
+        time the chunk is rendered. Seeded generations use a fixed chunk grid, so the first
+        images of the chunks and therefore the rendered poses are the same in every run.
+        Only the images of a failed chunk or of a lost render node are rendered with the
+        seed of the chunk their retry starts.
+
+        Args:
+            model_path: The model rendered in the chunk.
+            start: The number of the first image of the chunk.
+            attempt: How often rendering the images failed before.
+
+        Returns:
+            A 32 bit seed.
+        """
+
+        if self.seed is None:
+            return random.getrandbits(32)
+
+        key = "{}_{}_{}_{}".format(self.seed, pathlib.Path(model_path).stem, start, attempt)
+        return int.from_bytes(hashlib.sha256(key.encode()).digest()[:4], "big")
+
+    def _truncate_chunk(self, name, tmp_dir, complete):
+        """Shortens a failed chunk to the images that were completely written.
+
+        Blender renders the frames in order and reports each of them once it is written, so
+        the first complete frames that also have labels in the sidecar, if the chunk has one,
+        are kept and all others are deleted.
+
+        Args:
+            name: The name of the chunk.
+            tmp_dir: The temporary output directory of the chunk.
+            complete: How many frames were reported as written.
+
+        Returns:
+            How many images were kept.
+        """
+
+        # frames rendered after the sidecar was last written have no labels, so they are
+        # rendered again as well
+        chunk_labels = read_chunk_labels(tmp_dir)
+        if chunk_labels is not None:
+            complete = min(complete, len(chunk_labels))
+
+        with self.progress.lock:
+            # the images are named "<label>_<frame>.png"
+            for img_path in rendered_images(tmp_dir):
+                if int(img_path.stem.split("_")[1]) >= complete:
+                    os.remove(img_path)
+
+            if complete == 0:
+                self.progress.remove(name)
+                if tmp_dir.exists():
+                    shutil.rmtree(tmp_dir)
+                return 0
+
+            chunk = self.progress.chunks[name]
+            _, checksum = compute_checksum(tmp_dir)
+            state = PROCESSED if chunk["processed"] >= complete else RENDERED
+            self.progress.set_state(name, state, count=complete, rendered=complete, checksum=checksum)
+
+        return complete
+
+    def _fail_chunk(self, model_path, start, count):
+        """Records that images could not be rendered within the retries.
+
+        Args:
+            model_path: The model of the images.
+            start: The number of the first image.
+            count: How many images could not be rendered.
+        """
+
+        name = "tmp_{}_with_{}".format(start, count)
+        self.progress.add(name, model_path, count, start)
+        self.progress.set_state(name, FAILED)
+        self.failed.append(name)
+
+        print("Giving up on {} after {} attempts".format(name, self.retries + 1))
+
+
+class RenderWorker:
+    """A Blenderproc process that stays running and renders one chunk after another.
+
+    The process is started once and the chunks are sent to it over its stdin. This way
+    starting blender, loading the models and initializing the render devices only happens
+    once per process. The process reports its progress with
+    telemetry events, ending each chunk with a "chunk" event. If the process fails, it
+    exits and a new one is started for the next chunk.
+
+    Attributes:
+        blenderproc_run_path: Location of the blenderproc python script used as the entry point.
+        config_path: The path to the configuration file for Blenderproc.
+        blender_path: Location of the directory containing the blender executable.
+        env: The environment of the process, None to inherit the one of this process.
+        output: The last OUTPUT_LINES lines the process printed during the current chunk,
+          apart from the events.
+        returncode: The exit code of the last process that exited, None if none did.
+        lost: Always False, only remote workers can be lost.
+    """
+
+    def __init__(self, blenderproc_run_path, config_path, blender_path, env=None):
+        self.blenderproc_run_path = blenderproc_run_path
+        self.config_path = config_path
+        self.blender_path = blender_path
+        self.env = env
+
+        self.output = deque(maxlen=OUTPUT_LINES)
+        self.returncode = None
+        self.lost = False
+
+        self._process = None
+
+    def render(self, tmp_dir, model_path, count, seed=None, on_event=None):
+        """Renders a chunk and waits for it to finish.
+
+        Args:
+            tmp_dir: The directory the rendered images of this chunk are written to.
+            model_path: The model to use for rendering this chunk.
+            count: How many images should be rendered.
+            seed: The random seed used for the chunk, None to not seed it.
+            on_event: Called with every telemetry event of the process, apart from the
+              final "chunk" event.
+
+        Returns:
+            The "chunk" event of the process as a dict, None if the process exited without one.
+        """
+
+        self.output.clear()
+
+        args = [str(self.blender_path),  # blender install location
+                str(tmp_dir),            # temporary output directory
+                str(model_path),         # .blend model to use
+                str(count)]              # count to render
+
+        # the arguments are also needed on the command line to parse the setup of the config
+        if self._process is None:
+            self._process = subprocess.Popen(
+                ["python", str(self.blenderproc_run_path), "--worker", str(self.config_path)] + args,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                env=self.env,
+                universal_newlines=True
+            )
+
+        try:
+            self._process.stdin.write(json.dumps({"args": args, "seed": seed}) + "\n")
+            self._process.stdin.flush()
+        except BrokenPipeError:
+            self.close()
+            return None
+
+        for line in self._process.stdout:
+            event = parse_event(line)
+            if event is None:
+                self.output.append(line.rstrip())
+            elif event["event"] == "chunk":
+                if event["status"] != "done":
+                    self.close()
+
+                return event
+            elif on_event is not None:
+                on_event(event)
+
+        self.close()
+        return None
+
+    def close(self):
+        """Stops the process, if it is running.
+        """
+
+        if self._process is None:
+            return
+
+        # an empty line ends the process, closing stdin is not enough since processes forked
+        # in the meantime, like the ones processing the images, inherit its pipe
+        try:
+            self._process.stdin.write("\n")
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        # the remaining output has to be read, otherwise the process might block writing it
+        for line in self._process.stdout:
+            if parse_event(line) is None:
+                self.output.append(line.rstrip())
+
+        self.returncode = self._process.wait()
+        self._process = None
 
 
 def _get_root_path():
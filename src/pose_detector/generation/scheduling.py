@@ -0,0 +1,187 @@
+import threading
+from math import ceil
+
+# Blenderproc has overhead that scales with the number of images rendered, to avoid
+# too long rendering times a single process renders at most this many images
+MAX_PER_PROCESS = 2000
+
+# How many images the first chunk of each model contains, it is used to measure how
+# long the model takes to render
+PROBE_SIZE = 20
+
+# Each chunk should take at least this many times as long to render as starting blender
+MIN_OVERHEAD_FACTOR = 4
+
+# Each chunk takes at most 1 / (GUIDED_FACTOR * workers) of the remaining work, so the
+# chunks get smaller towards the end and all workers finish at about the same time
+GUIDED_FACTOR = 2
+
+# Size of the chunks of a seeded generation. Their boundaries must not depend on any
+# timing, so every run renders the same chunks with the same seeds.
+SEEDED_CHUNK_SIZE = 100
+
+
+class Scheduler:
+    """Hands out render chunks to the workers from a work queue.
+
+    The images of each model are assigned a range of image numbers, a chunk is a part
+    of such a range. The scheduler measures how long blender takes to start and how long
+    each model takes to render a frame, then sizes the chunks so the overhead stays small
+    while the chunks shrink as the remaining work does (guided self-scheduling).
+
+    The model with the most remaining work is always scheduled first, so slow models
+    start early and do not hold up the end of the rendering.
+
+    Chunks are active from being taken until they are released. Images of a released
+    chunk that were not rendered, for example because its worker was lost, are put back
+    into the queue.
+
+    If a grid is given, the chunks are not sized from the timings. Instead the image
+    numbers are split into cells of grid images and each chunk is the unassigned part
+    of a single cell, so the chunk boundaries are the same in every run.
+
+    Attributes:
+        ranges: For each model the ranges (start, end) of image numbers that are not
+          assigned to a chunk yet.
+        workers: How many workers render chunks in parallel.
+        overheads: The measured startup overheads in seconds.
+        frame_times: For each model the total measured render time and frame count.
+        active: How many chunks are taken but not released yet.
+        grid: The size of the cells the chunks are aligned to, None to size them from the
+          timings.
+    """
+
+    def __init__(self, ranges, workers=1, grid=None):
+        self.ranges = {model: sorted(model_ranges) for model, model_ranges in ranges.items()}
+        self.workers = workers
+        self.grid = grid
+        self.overheads = []
+        self.frame_times = {}
+        self.active = 0
+
+        self._lock = threading.Condition()
+
+    def next_chunk(self, wait=False):
+        """Takes the next chunk from the queue.
+
+        Args:
+            wait: Whether to wait while all images are assigned but active chunks might
+              still be released.
+
+        Returns:
+            A tuple (model, start, count), None if all images are assigned.
+        """
+
+        with self._lock:
+            while True:
+                remaining = {model: self._remaining(model) for model in self.ranges}
+                remaining = {model: count for model, count in remaining.items() if count > 0}
+                if remaining:
+                    break
+                if not wait or self.active == 0:
+                    return None
+                self._lock.wait()
+
+            model = max(remaining, key=lambda m: remaining[m] * self._frame_time(m))
+            start, end = self.ranges[model][0]
+
+            if self.grid is not None:
+                count = min((start // self.grid + 1) * self.grid, end) - start
+            else:
+                count = min(self._chunk_size(model, remaining), end - start)
+
+                # a tiny last chunk would mostly consist of overhead, so it is merged into this one
+                if end - start - count < count // 4:
+                    count = min(end - start, MAX_PER_PROCESS)
+
+            if count == end - start:
+                self.ranges[model].pop(0)
+            else:
+                self.ranges[model][0] = (start + count, end)
+
+            self.active += 1
+            return model, start, count
+
+    def release(self, model, start=0, count=0):
+        """Records that an active chunk is finished.
+
+        Args:
+            model: The model of the chunk.
+            start: The number of the first image that was not rendered.
+            count: How many images were not rendered and are put back into the queue.
+        """
+
+        with self._lock:
+            self.active -= 1
+            if count > 0:
+                self.ranges[model].append((start, start + count))
+                self.ranges[model].sort()
+            self._lock.notify_all()
+
+    def wait_finished(self):
+        """Waits until all images are assigned and no chunk is active anymore.
+        """
+
+        with self._lock:
+            while self.active > 0 or any(self._remaining(model) for model in self.ranges):
+                self._lock.wait()
+
+    def record(self, model, count, overhead, frame_time):
+        """Records the measured times of a rendered chunk.
+
+        Args:
+            model: The model rendered in the chunk.
+            count: How many images were rendered.
+            overhead: How many seconds blender took to start, None if unknown.
+            frame_time: How many seconds a single frame took to render.
+        """
+
+        with self._lock:
+            if overhead is not None:
+                self.overheads.append(overhead)
+
+            if count == 0:
+                return
+
+            total, frames = self.frame_times.get(model, (0, 0))
+            self.frame_times[model] = (total + frame_time * count, frames + count)
+
+    def _remaining(self, model):
+        """Returns how many images of a model are not assigned to a chunk yet.
+        """
+
+        return sum(end - start for start, end in self.ranges[model])
+
+    def _frame_time(self, model):
+        """Returns the estimated time to render a frame of a model.
+
+        Models that were not measured yet are assumed to be as fast as the average model.
+        """
+
+        if model in self.frame_times:
+            total, frames = self.frame_times[model]
+            return total / frames
+
+        if self.frame_times:
+            return sum(total / frames for total, frames in self.frame_times.values()) / len(self.frame_times)
+
+        return 1
+
+    def _chunk_size(self, model, remaining):
+        """Calculates how many images the next chunk of a model should contain.
+
+        Args:
+            model: The model of the chunk.
+            remaining: How many images of each model are not assigned to a chunk yet.
+        """
+
+        if model not in self.frame_times or not self.overheads:
+            return min(PROBE_SIZE, MAX_PER_PROCESS)
+
+        overhead = sum(self.overheads) / len(self.overheads)
+        frame_time = max(self._frame_time(model), 1e-6)
+
+        work = sum(count * self._frame_time(m) for m, count in remaining.items())
+        duration = max(work / (GUIDED_FACTOR * self.workers), MIN_OVERHEAD_FACTOR * overhead)
+
+        return max(1, min(ceil(duration / frame_time), MAX_PER_PROCESS))
@@ -0,0 +1,167 @@
+import json
+import threading
+import time
+from datetime import timedelta
+
+# Prefix of the lines containing telemetry events printed by the render workers
+EVENT_MARKER = "BLENDER_PROC_EVENT "
+
+REPORT_NAME = "render_report.json"
+
+# How many seconds to wait between printing the progress
+DISPLAY_INTERVAL = 10
+
+
+class RenderMonitor:
+    """Aggregates the telemetry events of the render workers.
+
+    Prints the progress of the rendering with an estimate of the remaining time and
+    collects timings per model, chunk and Blenderproc module. Once the rendering is
+    finished they are written to a report in the output directory.
+
+    Attributes:
+        total: How many images have to be rendered.
+        output_path: Directory where the report will be stored.
+        frames: How many images were rendered so far.
+        chunks: Mapping of chunk names to their timings.
+        modules: Mapping of Blenderproc blocks to their total duration and run count.
+        errors: The errors that occurred, along with the chunk they occurred in.
+    """
+
+    def __init__(self, total, output_path):
+        self.total = total
+        self.output_path = output_path
+        self.frames = 0
+        self.chunks = {}
+        self.modules = {}
+        self.errors = []
+
+        self._started = time.time()
+        self._displayed = self._started
+        self._lock = threading.Lock()
+
+    def start_chunk(self, name, model, count):
+        """Records that a chunk started rendering.
+
+        Args:
+            name: The name of the chunk.
+            model: The path of the model rendered in this chunk.
+            count: How many images the chunk should contain.
+        """
+
+        with self._lock:
+            self.chunks[name] = {
+                "model": model,
+                "count": count,
+                "frames": 0,
+                "status": "rendering",
+                "started": time.time(),
+                "duration": None,
+                "overhead": None,
+                "seconds_per_frame": None,
+            }
+
+    def handle(self, name, event):
+        """Handles a telemetry event of a worker.
+
+        Args:
+            name: The name of the chunk the worker is rendering.
+            event: The event as a dict.
+        """
+
+        with self._lock:
+            if event["event"] == "frame":
+                self.frames += 1
+                self.chunks[name]["frames"] += 1
+            elif event["event"] == "timing":
+                total, count = self.modules.get(event["block"], (0, 0))
+                self.modules[event["block"]] = (total + event["seconds"], count + 1)
+            elif event["event"] == "error":
+                self.errors.append({"chunk": name, "error": event["error"]})
+                print("Error while rendering {}:\n{}".format(name, event["error"]))
+
+        self._display()
+
+    def finish_chunk(self, name, status, overhead, frame_time, output=None):
+        """Records that a chunk is finished.
+
+        Args:
+            name: The name of the chunk.
+            status: "done" if the chunk was rendered, otherwise why it failed.
+            overhead: The seconds blender took to start, None if unknown.
+            frame_time: The seconds a single frame took to render.
+            output: The last lines the worker printed, stored along with failed chunks.
+        """
+
+        with self._lock:
+            chunk = self.chunks[name]
+            chunk.update(status=status, duration=time.time() - chunk["started"], overhead=overhead,
+                         seconds_per_frame=frame_time)
+
+            if status != "done":
+                self.errors.append({"chunk": name, "error": status, "output": output})
+
+    def write_report(self, failed=()):
+        """Writes the collected timings to the report in the output directory.
+
+        Args:
+            failed: The names of the chunks that could not be rendered within the retries.
+        """
+
+        with self._lock:
+            models = {}
+            for chunk in self.chunks.values():
+                model = models.setdefault(chunk["model"], {"chunks": 0, "frames": 0, "seconds": 0, "render_seconds": 0})
+                model["chunks"] += 1
+                model["frames"] += chunk["frames"]
+                model["seconds"] += chunk["duration"] or 0
+                model["render_seconds"] += (chunk["seconds_per_frame"] or 0) * chunk["frames"]
+
+            # the time per frame leaves out the time blender took to start
+            for model in models.values():
+                render_seconds = model.pop("render_seconds")
+                model["seconds_per_frame"] = render_seconds / model["frames"] if model["frames"] else None
+
+            report = {
+                "images": self.frames,
+                "duration": time.time() - self._started,
+                "models": models,
+                "chunks": self.chunks,
+                "modules": {block: {"runs": count, "seconds": total, "mean": total / count}
+                            for block, (total, count) in self.modules.items()},
+                "errors": self.errors,
+                "failed": list(failed),
+            }
+
+        with open(self.output_path.joinpath(REPORT_NAME), "w") as f:
+            json.dump(report, f, indent=2)
+
+    def _display(self):
+        """Prints the progress, at most every DISPLAY_INTERVAL seconds.
+        """
+
+        with self._lock:
+            now = time.time()
+            if now - self._displayed < DISPLAY_INTERVAL:
+                return
+
+            self._displayed = now
+            rate = self.frames / (now - self._started)
+            remaining = (self.total - self.frames) / rate if rate > 0 else 0
+
+            print("Rendered {}/{} images ({:.1f}%), {:.2f} images/s, ETA {}".format(
+                self.frames, self.total, 100 * self.frames / max(self.total, 1), rate,
+                timedelta(seconds=round(remaining))))
+
+
+def parse_event(line):
+    """Parses a line printed by a render worker.
+
+    Returns:
+        The event as a dict, None if the line is not an event.
+    """
+
+    if not line.startswith(EVENT_MARKER):
+        return None
+
+    return json.loads(line[len(EVENT_MARKER):])
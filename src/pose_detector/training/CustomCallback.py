@@ -7,6 +7,8 @@ import matplotlib.pyplot as plt
 class CustomCallback(tf.keras.callbacks.Callback):
     """
     Used to create a custom histogram of errors in the validation stage.
+
+    Models with several outputs get a histogram for each of them.
     """
 
     def __init__(self, log_dir, pred_data):
@@ -15,18 +17,38 @@ class CustomCallback(tf.keras.callbacks.Callback):
         self.pred_data = pred_data
 
     def on_epoch_end(self, epoch, logs=None):
-        def iterate(ds):
+        def iterate(ds, name=None):
             for _, labels in ds:
-                for label in labels:
+                if name is not None:
+                    labels = labels[name]
+                # several values per image are compared value by value, like the flattened predictions
+                for label in np.ravel(labels):
                     yield label
 
-        pred = self.model.predict(self.pred_data).ravel()
-        truth = np.fromiter(iterate(self.pred_data), float)
+        pred = self.model.predict(self.pred_data)
+
+        if isinstance(pred, dict):
+            for name, output in pred.items():
+                truth = np.fromiter(iterate(self.pred_data, name), float)
+                self._write_errors("Error/" + name, "Prediction/" + name, output.ravel(), truth, epoch,
+                                   hist_range=None)
+        else:
+            pred = pred.ravel()
+            truth = np.fromiter(iterate(self.pred_data), float)
+            self._write_errors("Error", "Prediction", pred, truth, epoch)
+
+    def _write_errors(self, error_name, prediction_name, pred, truth, epoch, hist_range=(-50, 50)):
+        """
+        Writes a histogram image of the errors and a histogram of the predictions.
+
+        The range of the error histogram fits the labels encoded in the image names, the labels
+        from the sidecar are not scaled, so their histograms use the range of the errors.
+        """
         error = pred - truth
 
         with self.writer.as_default():
             plt.figure(dpi=200)
-            plt.hist(error, range=(-50, 50), bins=100)
+            plt.hist(error, range=hist_range, bins=100)
             plt.xlabel('Error')
             plt.ylabel('Count')
 
@@ -37,6 +59,6 @@ class CustomCallback(tf.keras.callbacks.Callback):
             image = tf.expand_dims(image, 0)
             plt.clf()
 
-            tf.summary.image("Error", image, max_outputs=1, step=epoch)
+            tf.summary.image(error_name, image, max_outputs=1, step=epoch)
 
-            tf.summary.histogram("Prediction", pred, step=epoch)
\ No newline at end of file
+            tf.summary.histogram(prediction_name, pred, step=epoch)
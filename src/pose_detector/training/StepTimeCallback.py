@@ -0,0 +1,52 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+
+class StepTimeCallback(tf.keras.callbacks.Callback):
+    """
+    Measures how long each training step takes and prints the throughput after each epoch.
+
+    The first step is left out, it also traces and compiles the training step. Once the training is finished the
+    median over all epochs is printed along with the mode, so runs with different modes can be compared.
+    """
+
+    def __init__(self, batch_size, mode):
+        super().__init__()
+        self.batch_size = batch_size
+        self.mode = mode
+        self.step_times = []
+        self._epoch_start = 0
+        self._step_start = None
+        self._first_step = True
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch_start = len(self.step_times)
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        if self._step_start is None:
+            return
+
+        step_time = time.perf_counter() - self._step_start
+        if self._first_step:
+            self._first_step = False
+        else:
+            self.step_times.append(step_time)
+
+    def on_epoch_end(self, epoch, logs=None):
+        times = self.step_times[self._epoch_start:]
+        if times:
+            print(self._format("Epoch {}".format(epoch + 1), times))
+
+    def on_train_end(self, logs=None):
+        if self.step_times:
+            print(self._format("Training", self.step_times))
+
+    def _format(self, name, times):
+        step_time = float(np.median(times))
+        return "{}: {:.1f} ms/step, {:.0f} images/s ({})".format(name, step_time * 1000, self.batch_size / step_time,
+                                                                 self.mode)
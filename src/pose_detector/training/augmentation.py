@@ -0,0 +1,117 @@
+import numpy as np
+import tensorflow as tf
+
+from pose_detector.generation.backgrounds import BackgroundBank, CROP_SIZE
+
+# How many background crops are kept in memory for compositing
+BACKGROUND_POOL_SIZE = 2000
+
+
+def load_backgrounds(backgrounds_path, pool_size=BACKGROUND_POOL_SIZE):
+    """Creates a pool of random background crops, like the "pool" mode of the generation.
+
+    Args:
+        backgrounds_path: Directory containing the .jpg background images.
+        pool_size: How many crops are created.
+
+    Returns:
+        An uint8 array of shape (pool_size, CROP_SIZE, CROP_SIZE, 3) in RGB order.
+    """
+
+    paths = sorted(backgrounds_path.glob("*.jpg"))
+    if not paths:
+        raise ValueError("{} contains no .jpg backgrounds".format(backgrounds_path))
+
+    bank = BackgroundBank(paths, mode="pool", pool_size=pool_size)
+    bank.build()
+    try:
+        pool = np.fromfile(bank.pool_path, dtype=np.uint8).reshape((pool_size, CROP_SIZE, CROP_SIZE, 3))
+    finally:
+        bank.close()
+
+    # the bank stores the crops in the BGR order of opencv
+    return np.ascontiguousarray(pool[..., ::-1])
+
+
+class Augmentation:
+    """Augments batches of images during the training.
+
+    The training batches are randomly flipped and rotated by multiples of 90°, the same
+    transformations the generation applies to each image. Images with an alpha channel
+    are then put on top of random crops of the backgrounds, so every epoch shows each
+    rendered pose in a new variant. All of it works on whole batches.
+
+    The validation and test batches are only put on top of backgrounds, the same ones
+    in every epoch, so their results stay comparable.
+
+    The labels are not changed by the flips and rotations, so they are only applied to
+    labels that do not depend on the orientation of the image.
+
+    Attributes:
+        backgrounds: An uint8 tensor of background crops in RGB order, None to only drop
+          the alpha channel.
+        geometric: Whether the training images are flipped and rotated.
+    """
+
+    def __init__(self, backgrounds=None, geometric=True):
+        self.backgrounds = tf.constant(backgrounds) if backgrounds is not None else None
+        self.geometric = geometric
+
+    def augment_batch(self, images):
+        """Randomly flips, rotates and composites a batch of training images, the flips and
+        rotations are skipped unless geometric is set.
+
+        Args:
+            images: An uint8 tensor of shape (N, height, width, 3 or 4).
+
+        Returns:
+            The augmented images with 3 channels.
+        """
+
+        count = tf.shape(images)[0]
+
+        def choose(new_images):
+            return tf.where(tf.random.uniform([count, 1, 1, 1]) < .5, new_images, images)
+
+        # a transposition followed by random flips results in all 8 combinations of a flip
+        # and a rotation with the same probability
+        if self.geometric:
+            if images.shape[1] == images.shape[2]:
+                images = choose(tf.transpose(images, [0, 2, 1, 3]))
+            images = choose(tf.reverse(images, [1]))
+            images = choose(tf.reverse(images, [2]))
+
+        indices = tf.random.uniform([count], maxval=self._pool_size(), dtype=tf.int32)
+        return self._composite(images, indices)
+
+    def composite_batch(self, images, seed):
+        """Composites a batch of evaluation images, the backgrounds only depend on seed.
+
+        Args:
+            images: An uint8 tensor of shape (N, height, width, 3 or 4).
+            seed: The number of the batch.
+
+        Returns:
+            The images with 3 channels.
+        """
+
+        seed = tf.stack([tf.cast(seed, tf.int64), tf.constant(0, tf.int64)])
+        indices = tf.random.stateless_uniform([tf.shape(images)[0]], seed, maxval=self._pool_size(),
+                                              dtype=tf.int32)
+        return self._composite(images, indices)
+
+    def _pool_size(self):
+        return tf.shape(self.backgrounds)[0] if self.backgrounds is not None else 1
+
+    def _composite(self, images, indices):
+        """Puts images with an alpha channel on top of the backgrounds at indices.
+        """
+
+        if images.shape[-1] != 4 or self.backgrounds is None:
+            return images[..., :3]
+
+        backgrounds = tf.cast(tf.gather(self.backgrounds, indices), tf.float32)
+        alpha = tf.cast(images[..., 3:], tf.float32) / 255
+        blended = tf.cast(images[..., :3], tf.float32) * alpha + backgrounds * (1 - alpha)
+
+        return tf.cast(tf.round(blended), tf.uint8)
@@ -0,0 +1,66 @@
+import glob
+import hashlib
+import os
+
+from pose_detector.training.splits import CACHE_DIR, HASH_BUCKETS
+
+# Version of the cached data, changing how the images are decoded must increase it so
+# existing caches are not reused
+CACHE_VERSION = 1
+
+
+def dataset_fingerprint(data_dir, *params):
+    """Computes a fingerprint of a dataset directory and the parameters it is read with.
+
+    The fingerprint covers the name, size and modification time of every file in the
+    directory, so it changes as soon as images are added, removed or rewritten.
+
+    Args:
+        data_dir: The dataset directory.
+        *params: Further values the cached data depends on, like the targets.
+
+    Returns:
+        The fingerprint as a hex string.
+    """
+
+    fingerprint = hashlib.sha1()
+    fingerprint.update(repr((CACHE_VERSION, HASH_BUCKETS) + params).encode())
+
+    entries = sorted((entry for entry in os.scandir(data_dir) if entry.name != CACHE_DIR), key=lambda e: e.name)
+    for entry in entries:
+        stat = entry.stat()
+        fingerprint.update("{}:{}:{}\n".format(entry.name, stat.st_size, stat.st_mtime_ns).encode())
+
+    return fingerprint.hexdigest()
+
+
+def cache_path(cache_dir, fingerprint, name):
+    """Returns the path of the disk cache of a dataset and reports if it can be reused.
+
+    The tf.data cache consists of an index file and data files next to the path. A cache
+    is complete once its index exists, the files of an incomplete cache, for example of
+    an interrupted run, are removed so tf.data writes it again.
+
+    Args:
+        cache_dir: The directory the caches are stored in.
+        fingerprint: The fingerprint of the dataset, see dataset_fingerprint.
+        name: The name of the cached split.
+
+    Returns:
+        The path to pass to tf.data.Dataset.cache.
+    """
+
+    directory = cache_dir.joinpath(fingerprint[:16])
+    directory.mkdir(parents=True, exist_ok=True)
+    path = str(directory.joinpath(name))
+    files = glob.glob(glob.escape(path) + "[._]*")
+
+    if os.path.exists(path + ".index") and not glob.glob(glob.escape(path) + "_*.lockfile"):
+        size = sum(os.path.getsize(file) for file in files)
+        print("Cache hit for the {} split, reading {} bytes from {}".format(name, size, path))
+    else:
+        for file in files:
+            os.remove(file)
+        print("Cache miss for the {} split, it will be written to {} during the first epoch".format(name, path))
+
+    return path
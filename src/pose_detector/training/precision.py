@@ -0,0 +1,78 @@
+import tensorflow as tf
+
+# Precisions the model can be trained with:
+#   "float32": All layers compute in float32
+#   "mixed": The layers compute in float16 on GPUs and in bfloat16 on CPUs that support it,
+#     the variables and the outputs stay in float32
+PRECISIONS = ["float32", "mixed"]
+
+# Lowest compute capability of a GPU with tensor cores, older GPUs gain nothing from float16
+MIN_FLOAT16_CAPABILITY = (7, 0)
+
+# Flags of /proc/cpuinfo marking CPUs with bfloat16 instructions
+BFLOAT16_CPU_FLAGS = ["avx512_bf16", "amx_bf16"]
+
+
+def select_policy(precision):
+    """Selects the mixed precision policy for a precision on the available devices.
+
+    If the devices do not support the precision, the model is trained in float32.
+
+    Args:
+        precision: One of PRECISIONS.
+
+    Returns:
+        The name of the policy, "float32", "mixed_float16" or "mixed_bfloat16".
+    """
+
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision {}".format(precision))
+
+    if precision == "float32":
+        return "float32"
+
+    gpus = tf.config.list_physical_devices("GPU")
+    if gpus:
+        capabilities = [tf.config.experimental.get_device_details(gpu).get("compute_capability", (0, 0))
+                        for gpu in gpus]
+        if min(capabilities) >= MIN_FLOAT16_CAPABILITY:
+            return "mixed_float16"
+
+        print("The GPUs have a compute capability of {}, float16 needs at least {}, training in float32".format(
+            min(capabilities), MIN_FLOAT16_CAPABILITY))
+        return "float32"
+
+    if _cpu_supports_bfloat16():
+        print("No GPU found, training in bfloat16 on the CPU")
+        return "mixed_bfloat16"
+
+    print("No GPU found and the CPU has no bfloat16 instructions, training in float32")
+    return "float32"
+
+
+def set_policy(policy):
+    """Sets the mixed precision policy of all layers that are created afterwards.
+    """
+
+    mixed_precision = tf.keras.mixed_precision
+    if hasattr(mixed_precision, "set_global_policy"):
+        mixed_precision.set_global_policy(policy)
+    else:
+        # tensorflow 2.3 only has the experimental api
+        mixed_precision.experimental.set_policy(policy)
+
+
+def _cpu_supports_bfloat16():
+    """Whether the CPU has instructions for bfloat16, only detected on Linux.
+    """
+
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    flags = line.split(":", 1)[1].split()
+                    return any(flag in flags for flag in BFLOAT16_CPU_FLAGS)
+    except OSError:
+        pass
+
+    return False
@@ -0,0 +1,94 @@
+import os
+
+import numpy as np
+import tensorflow as tf
+
+# The splits a sample can be assigned to
+TRAIN = 0
+VALIDATION = 1
+TEST = 2
+SPLIT_NAMES = {TRAIN: "train", VALIDATION: "validation", TEST: "test"}
+
+# Number of hash buckets the samples are distributed over, the fractions are rounded to them
+HASH_BUCKETS = 10000
+
+# Directory inside a dataset holding the cached index of its images. Files written into it do
+# not change the modification time of the dataset directory the cache is checked against.
+CACHE_DIR = ".cache"
+INDEX_NAME = "image_index.npz"
+
+
+def assign_splits(nums, val_fraction=0.2, test_fraction=0.0):
+    """Assigns samples to the training, validation and test split by a hash of their number.
+
+    The assignment of a sample only depends on its number, so it is the same in every
+    epoch and every run, no matter in which order or format the samples are stored.
+    Increasing a fraction only moves samples from the training split into the other one.
+    Works on arrays as well as on tensors inside a dataset.
+
+    Args:
+        nums: The numbers of the samples.
+        val_fraction: Which fraction of the samples is used for validation.
+        test_fraction: Which fraction of the samples is held out for testing.
+
+    Returns:
+        The split of each sample, one of TRAIN, VALIDATION and TEST.
+    """
+
+    if val_fraction < 0 or test_fraction < 0 or val_fraction + test_fraction >= 1:
+        raise ValueError("The validation fraction {} and the test fraction {} must be positive and leave samples "
+                         "for training".format(val_fraction, test_fraction))
+
+    bucket = tf.strings.to_hash_bucket_fast(tf.strings.as_string(nums), HASH_BUCKETS)
+    test_buckets = round(test_fraction * HASH_BUCKETS)
+    val_buckets = test_buckets + round(val_fraction * HASH_BUCKETS)
+
+    splits = tf.where(bucket < test_buckets, tf.constant(TEST, tf.int64),
+                      tf.where(bucket < val_buckets, tf.constant(VALIDATION, tf.int64), tf.constant(TRAIN, tf.int64)))
+
+    return splits.numpy() if tf.executing_eagerly() else splits
+
+
+def image_index(data_dir):
+    """Lists the images of a dataset directory along with their numbers.
+
+    The directory is only listed once, the index is cached and reused until files are
+    added to or removed from the directory.
+
+    Args:
+        data_dir: The directory containing images named "<img_num>_<label>.png".
+
+    Returns:
+        An array of the image names and an array of their numbers, sorted by name.
+    """
+
+    cache_dir = data_dir.joinpath(CACHE_DIR)
+    index_path = cache_dir.joinpath(INDEX_NAME)
+
+    if index_path.exists():
+        with np.load(str(index_path)) as index:
+            if int(index["mtime"]) == data_dir.stat().st_mtime_ns:
+                return index["names"], index["nums"]
+
+    # creating the cache directory changes the modification time, so it is created before the
+    # time is read
+    try:
+        cache_dir.mkdir(exist_ok=True)
+    except OSError:
+        cache_dir = None
+    mtime = data_dir.stat().st_mtime_ns
+
+    names = np.array(sorted(entry.name for entry in os.scandir(data_dir) if entry.name.endswith(".png")))
+    nums = np.array([int(name.split("_")[0]) for name in names], dtype=np.int64)
+
+    # a dataset in a read-only location is just not cached
+    if cache_dir is not None:
+        try:
+            tmp_path = cache_dir.joinpath(INDEX_NAME + ".tmp")
+            with open(tmp_path, "wb") as f:
+                np.savez(f, names=names, nums=nums, mtime=np.int64(mtime))
+            os.replace(tmp_path, index_path)
+        except OSError:
+            pass
+
+    return names, nums
@@ -1,48 +1,152 @@
-import os
 from datetime import datetime
 
+import numpy as np
 import tensorflow as tf
+import yaml
+from pose_detector.generation import records
+from pose_detector.generation.labels import join_labels, label_sizes
+from pose_detector.training.augmentation import Augmentation, load_backgrounds
+from pose_detector.training.caching import cache_path, dataset_fingerprint
+from pose_detector.training.splits import TRAIN, VALIDATION, TEST, SPLIT_NAMES, assign_splits, image_index
 from pose_detector.training.CustomCallback import CustomCallback
+from pose_detector.training.StepTimeCallback import StepTimeCallback
+from pose_detector.training.precision import select_policy, set_policy
+from pose_detector.training.tuning import find_batch_size, scale_learning_rate
 
 from tensorflow.keras import layers
 from tensorflow.python.data.ops.dataset_ops import AUTOTUNE
 from tensorflow.python.keras.layers import GlobalAveragePooling2D, Dense, Dropout, BatchNormalization
-from tensorflow.python.keras.models import Sequential
+from tensorflow.python.keras.models import Model, Sequential
 from classification_models.tfkeras import Classifiers
 
+# Default hyperparameters, they can be changed with flags or a .yaml file, see _load_hyperparameters
+EPOCHS = 20
+BATCH_SIZE = 64
+SHUFFLE_BUFFER = 1000
+LEARNING_RATE = 0.0001
 
-def run(images_directory, save_path, base_model_name="resnet18"):
+
+def run(images_directory, save_path, base_model_name="resnet18", targets=None, loss_weights=None,
+        val_fraction=0.2, test_fraction=0.0, cache_dir=None, augment=False, backgrounds_path=None,
+        precision="float32", jit_compile=False, config_path=None, epochs=None, batch_size=None,
+        shuffle_buffer=None, learning_rate=None, autotune_batch_size=None):
     """Trains a CNN using a previously created dataset and transfer learning.
 
     Args:
         images_directory: Directory where the dataset is be stored.
         save_path: Directory where the final model will be stored.
         base_model_name: Name of the model architecture to use as a baseline.
+        targets: Comma separated names of the labels in the label sidecar of the dataset to
+          predict. The model gets an output for each of them. If None the label encoded in
+          the image names is predicted.
+        loss_weights: Comma separated weights of the targets like "open=2,wrist=0.5", targets
+          that are not listed get a weight of 1.
+        val_fraction: Which fraction of the dataset is used for validation.
+        test_fraction: Which fraction of the dataset is held out and only evaluated once
+          after the training.
+        cache_dir: Directory where the decoded images are cached, they are kept in memory if
+          None. The cache is reused as long as the dataset does not change.
+        augment: Whether the training images are randomly flipped and rotated each epoch,
+          see augmentation.Augmentation. With targets they are not flipped and rotated,
+          since the labels of the sidecar might depend on the orientation of the image.
+        backgrounds_path: Directory of backgrounds the images are put on top of during the
+          augmentation, requires a dataset generated with keep_alpha.
+        precision: The precision the layers compute in, see precision.PRECISIONS. Falls back
+          to float32 if the devices do not support it.
+        jit_compile: Whether the training step is compiled with XLA.
+        config_path: Path of a .yaml file containing the hyperparameters, the other arguments
+          take precedence over it.
+        epochs: How many epochs to train for.
+        batch_size: How many images are in a batch.
+        shuffle_buffer: How many images the training dataset is shuffled across.
+        learning_rate: The learning rate of the optimizer.
+        autotune_batch_size: Whether the batch size with the highest throughput is searched
+          before the training, the learning rate is scaled linearly with it.
     """
 
     img_size = (128, 128)
     img_shape = img_size + (3,)
 
-    train_dataset, val_dataset = _create_dataset(images_directory)
+    if targets is not None:
+        # dict.fromkeys removes duplicates while keeping the order
+        targets = list(dict.fromkeys(target.strip() for target in targets.split(",") if target.strip()))
+    elif loss_weights is not None:
+        raise ValueError("--loss-weights requires --targets")
+
+    # the targets are checked against the label sidecar before anything is loaded or built
+    outputs = None
+    if targets is not None:
+        outputs = label_sizes(images_directory, targets)
+
+    hyperparameters = _load_hyperparameters(config_path, epochs=epochs, batch_size=batch_size,
+                                            shuffle_buffer=shuffle_buffer, learning_rate=learning_rate,
+                                            autotune_batch_size=autotune_batch_size)
+    batch_size = hyperparameters["batch_size"]
+    learning_rate = hyperparameters["learning_rate"]
+
+    augmentation = None
+    if augment:
+        # flips and rotations keep the labels, which is wrong for labels like the camera pose
+        geometric = targets is None
+        if not geometric:
+            print("The targets might depend on the orientation of the images, the training images are not "
+                  "flipped and rotated")
+        augmentation = Augmentation(load_backgrounds(backgrounds_path) if backgrounds_path is not None else None,
+                                    geometric=geometric)
+    elif backgrounds_path is not None:
+        raise ValueError("--backgrounds requires --augment")
+
+    # the policy applies to all layers created afterwards, so it is set before the model is built
+    policy = select_policy(precision)
+    set_policy(policy)
+    if jit_compile:
+        tf.config.optimizer.set_jit(True)
+    mode = policy + (" with XLA" if jit_compile else "")
+    print("Training in " + mode)
+
+    BaseModel = Classifiers.get(base_model_name)[0]
+    base_model = BaseModel(input_shape=img_shape, weights='imagenet', include_top=False)
+    loss_weights = _parse_loss_weights(loss_weights, targets)
+    model = create_model(base_model, outputs, loss_weights, learning_rate)
+
+    if hyperparameters["autotune_batch_size"]:
+        tuned_batch_size = find_batch_size(model, img_shape, outputs)
+        learning_rate = scale_learning_rate(learning_rate, batch_size, tuned_batch_size)
+        batch_size = tuned_batch_size
+        print("Training with a batch size of {} and a learning rate of {:g}".format(batch_size, learning_rate))
+
+        # the search trained the optimizer on random images, so it is replaced
+        _compile_model(model, outputs, loss_weights, learning_rate)
+
+    train_dataset, val_dataset, test_dataset = _create_dataset(images_directory, targets, val_fraction, test_fraction,
+                                                               cache_dir, augmentation, batch_size,
+                                                               hyperparameters["shuffle_buffer"])
+
+    if outputs is not None:
+        train_dataset = _split_targets(train_dataset, outputs)
+        val_dataset = _split_targets(val_dataset, outputs)
+        if test_dataset is not None:
+            test_dataset = _split_targets(test_dataset, outputs)
 
     print('Number of train batches: %d' % tf.data.experimental.cardinality(train_dataset))
     print('Number of validation batches: %d' % tf.data.experimental.cardinality(val_dataset))
 
-    Model = Classifiers.get(base_model_name)[0]
-    base_model = Model(input_shape=img_shape, weights='imagenet', include_top=False)
-    model = create_model(base_model)
-
     log_dir = "logs/fit/" + "PoseDetection_" + datetime.now().strftime("%Y%m%d-%H%M%S")
     tensorboard_callback = tf.keras.callbacks.TensorBoard(log_dir=log_dir,
                                                           histogram_freq=1)
 
     test_callback = CustomCallback(log_dir, val_dataset)
+    step_time_callback = StepTimeCallback(batch_size, mode)
 
 
     model.fit(train_dataset,
-              epochs=20,
+              epochs=hyperparameters["epochs"],
               validation_data=val_dataset,
-              callbacks=[tensorboard_callback, test_callback])
+              callbacks=[tensorboard_callback, test_callback, step_time_callback])
+
+    if test_dataset is not None:
+        results = model.evaluate(test_dataset, return_dict=True)
+        print("Test results: " + ", ".join("{}: {:.4f}".format(name, value) for name, value in results.items()))
 
     # model must actually be in a subdir indicating the version
     save_path = save_path / "1"
@@ -71,15 +175,29 @@ def _freeze(base_model):
     return base_model
 
 
-def create_model(base_model):
+def create_model(base_model, outputs=None, loss_weights=None, learning_rate=LEARNING_RATE):
     """Creates the complete model.
 
     Adds layers to the base model and uses "mean squared error" as the loss function.
 
+    If outputs are given, the layers after the base model are shared and each target gets
+    its own output layer, so all of them are predicted in a single forward pass. Each
+    output has its own loss, weighted by loss_weights, and its own metrics.
+
+    Args:
+        base_model: The pretrained model the layers are added to.
+        outputs: A dict mapping the names of the targets to how many values they have,
+          None to predict a single value.
+        loss_weights: A dict mapping the names of the targets to the weights of their losses.
+        learning_rate: The learning rate of the optimizer.
+
     Returns:
         The complete model.
     """
 
+    if outputs is not None:
+        return _create_multi_output_model(base_model, outputs, loss_weights, learning_rate)
+
     base_model = _freeze(base_model)
     model = Sequential()
     model.add(base_model)
@@ -87,101 +205,432 @@ def create_model(base_model):
     model.add(Dense(256, activation='relu'))
     model.add(Dropout(.25))
     model.add(BatchNormalization())
-    model.add(Dense(1, activation='linear'))
+    # the output stays in float32 with a mixed precision policy
+    model.add(Dense(1, activation='linear', dtype='float32'))
     model.summary()
-    model.compile(loss="mean_squared_error", optimizer=tf.keras.optimizers.Adam(learning_rate=0.0001), metrics=['mean_absolute_error'])
+    _compile_model(model, learning_rate=learning_rate)
 
     return model
 
 
-def _create_dataset(data_dir):
+def _create_multi_output_model(base_model, outputs, loss_weights=None, learning_rate=LEARNING_RATE):
+    """Creates a model with an output for each target, see create_model.
+    """
+
+    base_model = _freeze(base_model)
+    x = GlobalAveragePooling2D()(base_model.output)
+    x = Dense(256, activation='relu')(x)
+    x = Dropout(.25)(x)
+    x = BatchNormalization()(x)
+
+    # the outputs stay in float32 with a mixed precision policy
+    heads = {name: Dense(size, activation='linear', name=name, dtype='float32')(x) for name, size in outputs.items()}
+
+    model = Model(inputs=base_model.input, outputs=heads)
+    model.summary()
+    _compile_model(model, outputs, loss_weights, learning_rate)
+
+    return model
+
+
+def _compile_model(model, outputs=None, loss_weights=None, learning_rate=LEARNING_RATE):
+    """Compiles a model created by create_model with a new optimizer.
+    """
+
+    if outputs is None:
+        model.compile(loss="mean_squared_error", optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate),
+                      metrics=['mean_absolute_error'])
+    else:
+        model.compile(loss={name: "mean_squared_error" for name in outputs},
+                      loss_weights=loss_weights,
+                      optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate),
+                      metrics={name: ['mean_absolute_error'] for name in outputs})
+
+
+def _load_hyperparameters(config_path=None, **values):
+    """Combines the default hyperparameters with the ones of a .yaml file and the given values.
+
+    Args:
+        config_path: Path of a .yaml file mapping names of hyperparameters to their values,
+          like "batch_size: 128". If None only the defaults and the given values are used.
+        **values: Values of the hyperparameters, None to use the one of the file or the default.
+
+    Returns:
+        A dict mapping the names of the hyperparameters to their values, cast to the types
+        of the defaults.
+    """
+
+    hyperparameters = {
+        "epochs": EPOCHS,
+        "batch_size": BATCH_SIZE,
+        "shuffle_buffer": SHUFFLE_BUFFER,
+        "learning_rate": LEARNING_RATE,
+        "autotune_batch_size": False,
+    }
+
+    if config_path is not None:
+        with open(config_path) as f:
+            config = yaml.safe_load(f) or {}
+
+        unknown = [key for key in config if key not in hyperparameters]
+        if unknown:
+            raise ValueError("Unknown hyperparameters {} in {}, available: {}".format(
+                ", ".join(unknown), config_path, ", ".join(hyperparameters)))
+        hyperparameters.update({key: _cast_hyperparameter(key, value, type(hyperparameters[key]))
+                                for key, value in config.items()})
+
+    hyperparameters.update({key: value for key, value in values.items() if value is not None})
+    return hyperparameters
+
+
+def _cast_hyperparameter(name, value, value_type):
+    """Casts the value of a hyperparameter from a .yaml file to the type of its default.
+
+    YAML loads numbers like 1e-4 as strings and integers where floats are expected, so
+    the values are converted and the ones that do not fit the type are rejected.
+    """
+
+    if value_type is bool:
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.lower() in ("true", "false"):
+            return value.lower() == "true"
+    else:
+        try:
+            number = float(value) if not isinstance(value, bool) else None
+        except (TypeError, ValueError):
+            number = None
+
+        if number is not None and (value_type is float or number.is_integer()):
+            return value_type(number)
+
+    raise ValueError("The hyperparameter {} must be {} {}, got {!r}".format(
+        name, "an" if value_type is int else "a", value_type.__name__, value))
+
+
+def _parse_loss_weights(loss_weights, targets):
+    """Parses the loss weights of the targets.
+
+    Args:
+        loss_weights: Comma separated weights like "open=2,wrist=0.5", or None.
+        targets: The names of the targets, None if there is only a single label.
+
+    Returns:
+        A dict mapping each target to its weight, None if there are no targets.
+    """
+
+    if targets is None:
+        return None
+
+    weights = {target: 1.0 for target in targets}
+    if loss_weights is None:
+        return weights
+
+    for item in loss_weights.split(","):
+        if not item.strip():
+            continue
+
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in weights:
+            raise ValueError("Loss weight for '{}', which is not one of the targets {}".format(
+                name, ", ".join(targets)))
+        weights[name] = float(weight)
+
+    return weights
+
+
+def _split_targets(ds, outputs):
+    """Splits the label vectors of a batched dataset into a dict with the values of each target.
+
+    Args:
+        ds: The dataset with the values of all targets concatenated, as created by _create_dataset.
+        outputs: A dict mapping the names of the targets to how many values they have, in the
+          order of the values.
+
+    Returns:
+        The dataset with a dict of labels for the outputs of the model.
+    """
+
+    def split(img, label):
+        labels = {}
+        offset = 0
+        for name, size in outputs.items():
+            labels[name] = label[..., offset:offset + size]
+            offset += size
+        return img, labels
+
+    return ds.map(split, num_parallel_calls=AUTOTUNE)
+
+
+def _create_dataset(data_dir, targets=None, val_fraction=0.2, test_fraction=0.0, cache_dir=None,
+                    augmentation=None, batch_size=BATCH_SIZE, shuffle_buffer=SHUFFLE_BUFFER):
     """Creates a dataset from all images in a directory.
 
     The images are expected to have a name of the format: "<img_num>_<label>.png".
     The numerical value stored at "label" will be used as the label for this image.
-    A 80/20 training/validation split is used.
+    If the directory contains TFRecord shards or raw images instead, the images and
+    labels are read from them.
+
+    If targets are given, the label of each image is a vector of the values of these
+    labels in the label sidecar of the dataset instead.
+
+    Each image is assigned to the training, validation or test split by a hash of its
+    number, see splits.assign_splits, so the splits never overlap.
+
+    The decoded images are cached in memory, or in cache_dir if it is given. Raw
+    datasets are not cached since they need no decoding.
+
+    If an augmentation is given, the images are loaded with their alpha channel and each
+    batch is augmented after it is read from the cache.
 
     Args:
         data_dir: The directory containing all images.
+        targets: The names of the labels to read from the label sidecar, see labels.join_labels.
+        val_fraction: Which fraction of the images is used for validation.
+        test_fraction: Which fraction of the images is held out for testing.
+        cache_dir: Directory where the decoded images are cached, None to cache them in memory.
+        augmentation: The Augmentation applied to the batches, None to not augment them.
+        batch_size: How many images are in a batch.
+        shuffle_buffer: How many images the training dataset is shuffled across.
 
     Returns:
-        The dataset split into training and validation.
+        The training, validation and test dataset, the test dataset is None if test_fraction is 0.
     """
 
-    image_count = sum(1 for _ in data_dir.glob("*.png"))
+    if records.has_raw(data_dir):
+        datasets = _create_raw_dataset(data_dir, targets, val_fraction, test_fraction, augmentation, batch_size)
+    else:
+        cache_paths = None
+        if cache_dir is not None:
+            # the images of an augmented dataset are cached with their alpha channel
+            fingerprint = dataset_fingerprint(data_dir, targets, val_fraction, test_fraction, augmentation is not None)
+            splits = (TRAIN, VALIDATION, TEST) if test_fraction > 0 else (TRAIN, VALIDATION)
+            cache_paths = {split: cache_path(cache_dir, fingerprint, SPLIT_NAMES[split]) for split in splits}
+
+        if records.has_shards(data_dir):
+            datasets = _create_shards_dataset(data_dir, targets, val_fraction, test_fraction, cache_paths,
+                                              augmentation, batch_size, shuffle_buffer)
+        else:
+            datasets = _create_images_dataset(data_dir, targets, val_fraction, test_fraction, cache_paths,
+                                              augmentation, batch_size, shuffle_buffer)
+
+    train_ds, val_ds, test_ds = datasets
+    return train_ds, val_ds, test_ds if test_fraction > 0 else None
+
+
+def _create_images_dataset(data_dir, targets=None, val_fraction=0.2, test_fraction=0.0, cache_paths=None,
+                           augmentation=None, batch_size=BATCH_SIZE, shuffle_buffer=SHUFFLE_BUFFER):
+    """Creates a dataset from the .png images in a directory.
+
+    The directory is listed only once, see splits.image_index.
+
+    Args:
+        data_dir: The directory containing the images.
+        targets: The names of the labels to read from the label sidecar.
+        val_fraction: Which fraction of the images is used for validation.
+        test_fraction: Which fraction of the images is held out for testing.
+        cache_paths: A dict mapping the splits to the paths of their disk caches.
+        augmentation: The Augmentation applied to the batches.
+        batch_size: How many images are in a batch.
+        shuffle_buffer: How many images the training dataset is shuffled across.
+
+    Returns:
+        The training, validation and test dataset.
+    """
+
+    names, nums = image_index(data_dir)
+    channels = 3 if augmentation is None else 4
+    paths = np.array([str(data_dir / name) for name in names])
+
+    if targets is None:
+        # the images are named "<img_num>_<label>.png"
+        image_labels = np.array([int(name[:-len(".png")].split("_")[1]) for name in names], dtype=np.int32)
+    else:
+        image_labels = join_labels(data_dir, nums, targets)
+
+    splits = assign_splits(nums, val_fraction, test_fraction)
+
+    datasets = []
+    for split in (TRAIN, VALIDATION, TEST):
+        mask = splits == split
+        ds = tf.data.Dataset.from_tensor_slices((paths[mask], image_labels[mask]))
+        if split == TRAIN:
+            # the index is sorted, the shuffle buffer after caching would only mix neighbouring images
+            ds = ds.shuffle(buffer_size=int(mask.sum()), reshuffle_each_iteration=False)
+
+        # Set "num_parallel_calls" so multiple images are loaded/processed in parallel.
+        ds = ds.map(lambda path, label: (_load_img(path, channels), label), num_parallel_calls=AUTOTUNE)
+        datasets.append(_configure_for_performance(ds, shuffle=split == TRAIN,
+                                                   cache_path=cache_paths.get(split) if cache_paths else None,
+                                                   augmentation=augmentation, batch_size=batch_size,
+                                                   shuffle_buffer=shuffle_buffer))
+
+    return datasets
+
 
-    list_ds = tf.data.Dataset.list_files(str(data_dir / "*.png"), shuffle=True)
+def _create_shards_dataset(data_dir, targets=None, val_fraction=0.2, test_fraction=0.0, cache_paths=None,
+                           augmentation=None, batch_size=BATCH_SIZE, shuffle_buffer=SHUFFLE_BUFFER):
+    """Creates a dataset from the TFRecord shards in a directory.
 
-    val_size = int(image_count * 0.2)
-    train_ds = list_ds.skip(val_size)
-    val_ds = list_ds.take(val_size)
+    Every split reads all shards and keeps the images assigned to it, only those are decoded.
+    The training split reads the shards in a random order and alternates between several of
+    them, so the shuffle buffer after the cache does not only mix images of the same chunk.
 
-    # Set "num_parallel_calls" so multiple images are loaded/processed in parallel.
-    train_ds = train_ds.map(_process_path, num_parallel_calls=AUTOTUNE)
-    val_ds = val_ds.map(_process_path, num_parallel_calls=AUTOTUNE)
+    Args:
+        data_dir: The directory containing the shards.
+        targets: The names of the labels to read from the label sidecar.
+        val_fraction: Which fraction of the images is used for validation.
+        test_fraction: Which fraction of the images is held out for testing.
+        cache_paths: A dict mapping the splits to the paths of their disk caches.
+        augmentation: The Augmentation applied to the batches.
+        batch_size: How many images are in a batch.
+        shuffle_buffer: How many images the training dataset is shuffled across.
+
+    Returns:
+        The training, validation and test dataset.
+    """
 
-    train_ds = _configure_for_performance(train_ds, shuffle=True)
-    val_ds = _configure_for_performance(val_ds)
+    channels = 3 if augmentation is None else 4
 
-    return train_ds, val_ds
+    datasets = []
+    for split in (TRAIN, VALIDATION, TEST):
+        ds, _ = records.read_shards(data_dir, targets, shuffle=split == TRAIN)
+        split_ds = ds.filter(lambda img, label, num, split=split:
+                             tf.equal(assign_splits(num, val_fraction, test_fraction), split))
+        split_ds = split_ds.map(lambda img, label, num: (tf.image.decode_png(img, channels=channels), label),
+                                num_parallel_calls=AUTOTUNE)
+        datasets.append(_configure_for_performance(split_ds, shuffle=split == TRAIN,
+                                                   cache_path=cache_paths.get(split) if cache_paths else None,
+                                                   augmentation=augmentation, batch_size=batch_size,
+                                                   shuffle_buffer=shuffle_buffer))
 
+    return datasets
 
-def _process_path(file_path):
-    """Maps a path to an decoded image and a label.
+
+def _create_raw_dataset(data_dir, targets=None, val_fraction=0.2, test_fraction=0.0, augmentation=None,
+                        batch_size=BATCH_SIZE):
+    """Creates a dataset from the raw images in a directory.
+
+    The images are memory-mapped and each batch is sliced directly out of the mapped
+    file. Nothing needs to be decoded and the dataset is not cached in memory, so it can
+    be larger than the available RAM.
 
     Args:
-        file_path: The path of the image.
+        data_dir: The directory containing the raw images.
+        targets: The names of the labels to read from the label sidecar.
+        val_fraction: Which fraction of the images is used for validation.
+        test_fraction: Which fraction of the images is held out for testing.
+        augmentation: The Augmentation applied to the batches.
+        batch_size: How many images are in a batch.
 
     Returns:
-        A tuple of (image, label)
+        The training, validation and test dataset.
     """
 
-    label = _extract_label(file_path)
-    img = _load_img(file_path)
+    images, image_labels, nums = records.read_raw(data_dir, targets)
+    splits = assign_splits(nums, val_fraction, test_fraction)
+
+    return [_slice_raw_batches(images, image_labels, np.flatnonzero(splits == split), shuffle=split == TRAIN,
+                               augmentation=augmentation, batch_size=batch_size)
+            for split in (TRAIN, VALIDATION, TEST)]
 
-    return img, label
 
+def _slice_raw_batches(images, labels, indices, shuffle=False, augmentation=None, batch_size=BATCH_SIZE):
+    """Creates a batched dataset reading the images at the given indices.
 
-def _extract_label(file_path):
-    """Extract the label from an image path.
+    Args:
+        images: The memory-mapped images.
+        labels: The labels of all images.
+        indices: The indices of the images to include.
+        shuffle: If the dataset should be shuffled each iteration.
+        augmentation: The Augmentation applied to the batches.
+        batch_size: How many images are in a batch.
+
+    Returns:
+        The batched dataset.
     """
 
-    # convert the path to a list of path components
-    label = tf.strings.split(file_path, os.path.sep)[-1]
+    # the alpha channel is only kept for the augmentation
+    channels = images.shape[-1] if augmentation is not None else 3
 
-    # expecting file name of the format <num>_<training>.png
-    label = tf.strings.split(label, "_")[1]
+    def read_batch(batch_indices):
+        # reading in ascending order keeps the accesses to the mapped file sequential
+        batch_indices = np.sort(batch_indices)
+        return images[batch_indices][..., :channels], labels[batch_indices]
 
-    # remove file extension
-    label = tf.strings.split(label, ".")[0]
-    label = tf.strings.to_number(label, out_type=tf.dtypes.int32)
-    return label
+    def read(batch_indices):
+        batch_images, batch_labels = tf.numpy_function(read_batch, [batch_indices],
+                                                       [tf.uint8, tf.as_dtype(labels.dtype)])
+        batch_images.set_shape((None,) + images.shape[1:-1] + (channels,))
+        batch_labels.set_shape((None,) + labels.shape[1:])
+        return batch_images, batch_labels
 
+    ds = tf.data.Dataset.from_tensor_slices(indices)
+    if shuffle:
+        ds = ds.shuffle(buffer_size=len(indices), reshuffle_each_iteration=True)
+    ds = ds.batch(batch_size)
+    ds = ds.map(read, num_parallel_calls=AUTOTUNE)
+    ds = _augment(ds, augmentation, shuffle)
+    ds = ds.prefetch(buffer_size=AUTOTUNE)
 
-def _load_img(file_path):
+    return ds
+
+
+def _load_img(file_path, channels=3):
     """Loads and decodes an image.
+
+    Args:
+        channels: 3 to load the RGB channels, 4 to also load the alpha channel.
     """
 
     # load the raw data from the file as a string
     img = tf.io.read_file(file_path)
 
     # convert the compressed string to a 3D uint8 tensor
-    img = tf.image.decode_png(img, channels=3)
+    img = tf.image.decode_png(img, channels=channels)
 
     return img
 
 
-def _configure_for_performance(ds, shuffle=False):
+def _configure_for_performance(ds, shuffle=False, cache_path=None, augmentation=None, batch_size=BATCH_SIZE,
+                               shuffle_buffer=SHUFFLE_BUFFER):
     """Enables caching and prefetching on a dataset.
 
     Args:
-        shuffle: If the dataset should be shuffled each iteration.
+        shuffle: If the dataset should be shuffled each iteration, the training dataset is.
+        cache_path: Path of a file to cache the dataset in, it is cached in memory if None.
+        augmentation: The Augmentation applied to each batch after it is read from the cache.
+        batch_size: How many images are in a batch.
+        shuffle_buffer: How many images the dataset is shuffled across.
     """
 
-    ds = ds.cache()
+    ds = ds.cache(cache_path or "")
     if shuffle:
-        ds = ds.shuffle(buffer_size=1000, reshuffle_each_iteration=True)
-    ds = ds.batch(64)
+        ds = ds.shuffle(buffer_size=shuffle_buffer, reshuffle_each_iteration=True)
+    ds = ds.batch(batch_size)
+    ds = _augment(ds, augmentation, shuffle)
     ds = ds.prefetch(buffer_size=AUTOTUNE)
 
     return ds
+
+
+def _augment(ds, augmentation, training):
+    """Applies an Augmentation to the batches of a dataset.
+
+    Args:
+        augmentation: The Augmentation, if None the dataset is returned unchanged.
+        training: Whether the batches are randomly augmented, otherwise they only get
+          backgrounds that are the same in every epoch.
+    """
+
+    if augmentation is None:
+        return ds
+
+    if training:
+        return ds.map(lambda images, labels: (augmentation.augment_batch(images), labels),
+                      num_parallel_calls=AUTOTUNE)
+
+    # the backgrounds are chosen by the number of the batch
+    return ds.enumerate().map(lambda i, batch: (augmentation.composite_batch(batch[0], i), batch[1]),
+                              num_parallel_calls=AUTOTUNE)
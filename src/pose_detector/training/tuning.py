@@ -0,0 +1,96 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+# Batch sizes tried by find_batch_size, each one twice as large as the previous one
+MIN_BATCH_SIZE = 16
+MAX_BATCH_SIZE = 1024
+
+# How many steps are run with each batch size before and while measuring the throughput
+WARMUP_STEPS = 2
+MEASURED_STEPS = 5
+
+
+def find_batch_size(model, input_shape, outputs=None, max_batch_size=MAX_BATCH_SIZE):
+    """Finds the batch size the model trains the most images per second with.
+
+    Runs a few training steps on random images with increasing batch sizes, until the
+    device runs out of memory or the throughput stops increasing. The weights of the
+    model are restored afterwards, its optimizer has to be recreated by compiling it
+    again.
+
+    Args:
+        model: The compiled model.
+        input_shape: The shape of a single image.
+        outputs: A dict mapping the names of the targets to how many values they have,
+          None if the model predicts a single value.
+        max_batch_size: The largest batch size that is tried.
+
+    Returns:
+        The batch size with the highest throughput.
+    """
+
+    weights = model.get_weights()
+    best_batch_size = None
+    best_throughput = 0
+
+    batch_size = MIN_BATCH_SIZE
+    try:
+        while batch_size <= max_batch_size:
+            try:
+                throughput = _measure_throughput(model, input_shape, outputs, batch_size)
+            except tf.errors.ResourceExhaustedError:
+                print("Batch size {}: out of memory".format(batch_size))
+                break
+
+            print("Batch size {}: {:.0f} images/s".format(batch_size, throughput))
+            if throughput <= best_throughput:
+                break
+
+            best_batch_size = batch_size
+            best_throughput = throughput
+            batch_size *= 2
+    finally:
+        model.set_weights(weights)
+
+    if best_batch_size is None:
+        raise ValueError("The model does not fit into memory with a batch size of {}".format(MIN_BATCH_SIZE))
+
+    return best_batch_size
+
+
+def scale_learning_rate(learning_rate, batch_size, tuned_batch_size):
+    """Scales a learning rate linearly with the batch size.
+
+    Args:
+        learning_rate: The learning rate used with batch_size.
+        batch_size: The batch size the learning rate was chosen for.
+        tuned_batch_size: The new batch size.
+
+    Returns:
+        The learning rate for tuned_batch_size.
+    """
+
+    return learning_rate * tuned_batch_size / batch_size
+
+
+def _measure_throughput(model, input_shape, outputs, batch_size):
+    """Measures how many images per second the model trains with a batch size.
+    """
+
+    images = np.random.randint(0, 256, (batch_size,) + tuple(input_shape), dtype=np.uint8)
+    if outputs is None:
+        labels = np.zeros(batch_size, dtype=np.float32)
+    else:
+        labels = {name: np.zeros((batch_size, size), dtype=np.float32) for name, size in outputs.items()}
+
+    for _ in range(WARMUP_STEPS):
+        model.train_on_batch(images, labels)
+
+    # train_on_batch returns the loss as a number, so each step is finished once it returns
+    start = time.perf_counter()
+    for _ in range(MEASURED_STEPS):
+        model.train_on_batch(images, labels)
+
+    return batch_size * MEASURED_STEPS / (time.perf_counter() - start)
@@ -25,6 +25,7 @@
 parser.add_argument('--batch_process', help='Renders a batch of house-cam combinations, by reading a file containing the combinations on each line, where each line is the standard placeholder arguments for rendering a single scene separated by spaces. The value of this option is the path to the index file, no need to add placeholder arguments.')
 parser.add_argument('--temp-dir', dest='temp_dir', default=None, help="The path to a directory where all temporary output files should be stored. If it doesn't exist, it is created automatically. Type: string. Default: \"/dev/shm\" or \"/tmp/\" depending on which is available.")
 parser.add_argument('--keep-temp-dir', dest='keep_temp_dir', action='store_true', help="If set, the temporary directory is not removed in the end.")
+parser.add_argument('--worker', dest='worker', action='store_true', help="If set, blender stays running and reads the chunks to render from stdin, one json object per line with the \"args\" of the chunk and the \"seed\" of the random generators, until an empty line is read or stdin is closed. See src/run_worker.py.")
 parser.add_argument('-h', '--help', dest='help', action='store_true', help='Show this help message and exit.')
 args = parser.parse_args()
 
@@ -249,7 +250,7 @@ def __call__(self, block_num, block_size, total_size):
     raise Exception("This system is not supported yet: {}".format(platform))
 
 repo_root_directory = os.path.dirname(os.path.realpath(__file__))
-path_src_run = os.path.join(repo_root_directory, "src/run.py")
+path_src_run = os.path.join(repo_root_directory, "src/run_worker.py" if args.worker else "src/run.py")
 
 # Determine perfect temp dir
 if args.temp_dir is None:
@@ -24,6 +24,9 @@ class Initializer(Module):
      If you want deterministic outputs use the environment variable: "BLENDER_PROC_RANDOM_SEED" and set it to
      the desired seed. (random and numpy random are effected by this)
 
+     The environment variable "BLENDER_PROC_DEVICE" can be set to "CPU" to render on the CPU, even if GPUs are
+     available. Which GPUs are used can be restricted with "CUDA_VISIBLE_DEVICES".
+
     **Configuration**:
 
     .. list-table:: 
@@ -63,8 +66,8 @@ def run(self):
         # Use cycles
         bpy.context.scene.render.engine = 'CYCLES'
 
-        if platform == "darwin":
-            # there is no gpu support in mac os so use the cpu with maximum power
+        if platform == "darwin" or os.getenv("BLENDER_PROC_DEVICE") == "CPU":
+            # there is no gpu support in mac os, otherwise the cpu was requested, so use the cpu with maximum power
             bpy.context.scene.cycles.device = "CPU"
             bpy.context.scene.render.threads = multiprocessing.cpu_count()
         else:
@@ -0,0 +1,113 @@
+import bpy
+
+from src.main.Pipeline import Pipeline
+from src.utility.Utility import Utility
+
+
+class PersistentPipeline:
+    """
+    Runs the pipeline repeatedly inside a single blender process, once for each chunk of images.
+
+    The modules that set up the scene, the main.Initializer and all loaders, only run for the first chunk or
+    when the config of a loader changes, for example because another .blend file should be rendered. For all
+    other chunks the scene is reset to the state right after the setup and only the remaining modules run again.
+    This way blender, the loaded models and the render devices are only initialized once per process.
+
+    The reset removes everything the remaining modules added to the scene: actions holding their keyframes,
+    objects, handlers and custom properties of the scene. Keyframes inserted into actions that already existed
+    after the setup are overwritten by the next chunk.
+    """
+
+    def __init__(self, config_path, working_dir, temp_dir):
+        """
+        :param config_path: path to the config
+        :param working_dir: the current working dir usually the place where the run.py sits
+        :param temp_dir: the directory where to put temporary files during the execution
+        """
+        self.config_path = config_path
+        self.working_dir = working_dir
+        self.temp_dir = temp_dir
+
+        self._loader_configs = None
+        self._base_handlers = self._get_handlers()
+        self._handlers = None
+        self._actions = None
+        self._objects = None
+        self._scene_keys = None
+
+    def run(self, args):
+        """ Runs the pipeline for a single chunk.
+
+        :param args: arguments which are specified in the config file
+        """
+        pipeline = Pipeline(self.config_path, args, self.working_dir, self.temp_dir, should_perform_clean_up=False)
+
+        loader_configs = [module.config.data for module in pipeline.modules if self._is_loader(module)]
+        rebuild = loader_configs != self._loader_configs
+        if rebuild:
+            pipeline._cleanup()
+            self._restore_handlers(self._base_handlers)
+            self._loader_configs = loader_configs
+        else:
+            self._reset()
+
+        with Utility.BlockStopWatch("Running blender pipeline"):
+            for module in pipeline.modules:
+                if self._is_setup(module):
+                    if not rebuild:
+                        continue
+                elif rebuild:
+                    self._save_state()
+                    rebuild = False
+
+                with Utility.BlockStopWatch("Running module " + module.__class__.__name__):
+                    module.run()
+
+    def _is_loader(self, module):
+        """ Whether a module loads objects into the scene. """
+        return module.__class__.__module__.startswith("src.loader.")
+
+    def _is_setup(self, module):
+        """ Whether a module sets up the scene and only has to run once. """
+        return module.__class__.__module__ == "src.main.Initializer" or self._is_loader(module)
+
+    def _save_state(self):
+        """ Remembers the state of the scene right after the setup. """
+        self._handlers = self._get_handlers()
+        self._actions = set(action.name for action in bpy.data.actions)
+        self._objects = set(obj.name for obj in bpy.data.objects)
+        self._scene_keys = set(bpy.context.scene.keys())
+
+    def _reset(self):
+        """ Resets the scene to the state right after the setup. """
+        for action in list(bpy.data.actions):
+            if action.name not in self._actions:
+                bpy.data.actions.remove(action)
+
+        for obj in list(bpy.data.objects):
+            if obj.name not in self._objects:
+                bpy.data.objects.remove(obj, do_unlink=True)
+
+        for key in list(bpy.context.scene.keys()):
+            if key not in self._scene_keys:
+                del bpy.context.scene[key]
+
+        self._restore_handlers(self._handlers)
+
+        # the camera samplers append their poses after the last frame
+        bpy.context.scene.frame_end = 0
+
+    def _get_handlers(self):
+        """ Returns a copy of all registered application handlers. """
+        handlers = {}
+        for name in dir(bpy.app.handlers):
+            value = getattr(bpy.app.handlers, name)
+            if isinstance(value, list):
+                handlers[name] = list(value)
+
+        return handlers
+
+    def _restore_handlers(self, handlers):
+        """ Replaces all registered application handlers with the given ones. """
+        for name, value in handlers.items():
+            getattr(bpy.app.handlers, name)[:] = value
@@ -0,0 +1,156 @@
+import os
+from pathlib import Path
+
+import bpy
+import numpy as np
+
+from src.main.Module import Module
+from src.utility.Utility import Utility
+
+
+class LabelSidecarWriter(Module):
+    """
+    Writes the labels of every rendered image into a "labels.npz" file next to the images.
+
+    For each rendered frame the custom properties of an entity, the pose of the camera and the base color of a
+    material are recorded. They are stored as columns of numpy arrays, the "frame" column contains the frame number
+    of each row, which is also the number at the end of the image name. An empty file is written when the rendering
+    starts, so readers know labels will follow. The file is then rewritten every write_interval frames and once the
+    rendering is complete, so images that are already on disk might not have labels yet until the next write.
+
+    The values are read after all other frame change handlers ran, so this module should come after the
+    CameraOffset in the config.
+
+    Example:
+
+    .. code-block:: yaml
+
+        {
+          "module": "renderer.LabelSidecarWriter",
+          "config": {
+            "entity": "Armature",
+            "properties": ["open", "wrist", "rot", "elbow", "deviation"],
+            "material": "Material.001"
+          }
+        }
+
+    Result: The sidecar contains the columns "frame", "open", "wrist", "rot", "elbow", "deviation",
+        "camera_location", "camera_rotation" and "color".
+
+    **Configuration**:
+
+    .. csv-table::
+        :header: "Parameter", "Description"
+
+        "entity", "Name of the entity to read the custom properties from."
+        "properties", "Names of the custom properties to store. Default: All numeric custom properties of the entity."
+        "material", "Name of the material whose base color is stored as color. Default: No color is stored."
+        "write_interval", "After how many frames the file is rewritten while rendering. Default: 100."
+    """
+
+    # Name of the written file
+    FILE_NAME = "labels.npz"
+
+    def __init__(self, config):
+        Module.__init__(self, config)
+        self.output_dir = None
+        self.rows = {}
+        self.unwritten = 0
+
+    def run(self):
+
+        def handler_render_init(scene):
+            """
+            Starts a new sidecar in the output directory of the rendering that is starting.
+            """
+
+            nonlocal self
+
+            self.output_dir = Path(bpy.context.scene.render.filepath).parent
+            self.rows = {}
+            self.write()
+
+        def handler_record_labels(scene, depsgraph):
+            """
+            Records the labels of the current frame.
+            """
+
+            nonlocal self
+
+            if self.output_dir is not None:
+                self.rows[scene.frame_current] = self.get_labels(depsgraph)
+
+        def handler_write_labels(scene, *args):
+            """
+            Writes the labels of all frames rendered so far every write_interval frames.
+            """
+
+            nonlocal self
+
+            self.unwritten += 1
+            if self.unwritten >= self.config.get_int("write_interval", 100):
+                self.write(scene.frame_current)
+
+        def handler_render_complete(scene, *args):
+            """
+            Writes the labels of all rendered frames.
+            """
+
+            nonlocal self
+
+            self.write()
+
+        bpy.types.RenderSettings.use_lock_interface = True
+        bpy.app.handlers.render_init.append(handler_render_init)
+        bpy.app.handlers.frame_change_post.append(handler_record_labels)
+        bpy.app.handlers.render_write.append(handler_write_labels)
+        bpy.app.handlers.render_complete.append(handler_render_complete)
+
+    def get_labels(self, depsgraph):
+        """
+        Returns: A dict with the labels of the current frame.
+        """
+
+        labels = {}
+
+        eo = bpy.context.scene.objects[self.config.data["entity"]].evaluated_get(depsgraph)
+        properties = self.config.get_list("properties", [key for key in eo.keys()
+                                                         if isinstance(eo[key], (int, float))])
+        for key in properties:
+            labels[key] = float(eo[key])
+
+        cam = bpy.context.scene.camera.evaluated_get(depsgraph)
+        labels["camera_location"] = list(cam.matrix_world.translation)
+        labels["camera_rotation"] = list(cam.matrix_world.to_euler())
+
+        if self.config.has_param("material"):
+            material = bpy.data.materials[self.config.get_string("material")]
+            principled_bsdf = Utility.get_the_one_node_with_type(material.node_tree.nodes, "BsdfPrincipled")
+            labels["color"] = list(principled_bsdf.inputs["Base Color"].default_value)
+
+        return labels
+
+    def write(self, last_frame=None):
+        """
+        Writes the labels of all recorded frames up to last_frame into the sidecar.
+
+        The file is replaced atomically, so it can be read while the rendering is still running.
+
+        :param last_frame: The last frame that is already rendered, None to write all recorded frames.
+        """
+
+        if self.output_dir is None:
+            return
+
+        frames = sorted(frame for frame in self.rows if last_frame is None or frame <= last_frame)
+        columns = {"frame": np.array(frames, dtype=np.int32)}
+        if frames:
+            for key in self.rows[frames[0]]:
+                columns[key] = np.array([self.rows[frame][key] for frame in frames], dtype=np.float32)
+
+        path = self.output_dir.joinpath(self.FILE_NAME)
+        tmp_path = self.output_dir.joinpath(self.FILE_NAME + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **columns)
+        os.replace(tmp_path, path)
+        self.unwritten = 0
@@ -0,0 +1,149 @@
+import bpy
+
+from src.renderer.RendererInterface import RendererInterface
+from src.utility.Utility import Utility
+
+
+class RasterRenderer(RendererInterface):
+    """
+    Renders rgb images for each registered keypoint with one of Blender's rasterizing engines instead of Cycles.
+
+    Eevee and Workbench render a small image in a fraction of the time Cycles needs, at the cost of less accurate
+    lighting. Images are stored as PNG-files or uncompressed TGA-files with 8bit color depth, like the ones of the
+    RgbRenderer, so it can be used in its place together with the RenderFilePathOverwriter.
+
+    Workbench does not evaluate the shader nodes of a material and shows its viewport color instead, so the base
+    color of the Principled BSDF is copied to the viewport color of every material for each frame.
+
+    Both engines need an OpenGL context, on a headless machine Blender has to run on a virtual display like Xvfb.
+
+    Example:
+
+    .. code-block:: yaml
+
+        {
+          "module": "renderer.RasterRenderer",
+          "config": {
+            "output_key": "colors",
+            "engine": "EEVEE",
+            "transparent_background": True
+          }
+        }
+
+    .. list-table::
+        :widths: 25 100 10
+        :header-rows: 1
+
+        * - Parameter
+          - Description
+          - Type
+        * - engine
+          - The engine to render with, Default: 'EEVEE'. Available: ['EEVEE', 'WORKBENCH']
+          - str
+        * - samples
+          - Number of anti-aliasing samples per pixel, Workbench uses the next larger one of 5, 8, 11, 16 and 32,
+            Default: 16.
+          - int
+        * - use_ambient_occlusion
+          - Whether Eevee renders ambient occlusion, Default: True.
+          - bool
+        * - use_soft_shadows
+          - Whether Eevee renders soft shadows, Default: True.
+          - bool
+        * - image_type
+          - Image type of saved rendered images, Default: 'PNG'. Available: ['PNG','TGA']
+          - str
+        * - transparent_background
+          - Whether to render the background as transparent or not, Default: False.
+          - bool
+    """
+
+    # The Blender names of the supported engines
+    ENGINES = {
+        "EEVEE": "BLENDER_EEVEE",
+        "WORKBENCH": "BLENDER_WORKBENCH",
+    }
+
+    def __init__(self, config):
+        RendererInterface.__init__(self, config)
+        self._engine = config.get_string("engine", "EEVEE").upper()
+        self._samples = config.get_int("samples", 16)
+        self._image_type = config.get_string("image_type", "PNG")
+
+        if self._engine not in self.ENGINES:
+            raise Exception("Unknown engine " + self._engine + ", available: " + ", ".join(self.ENGINES))
+        if self._image_type not in ("PNG", "TGA"):
+            raise Exception("Unknown Image Type " + self._image_type)
+
+    def run(self):
+        # if the rendering is not performed -> it is probably the debug case.
+        do_undo = not self._avoid_rendering
+        with Utility.UndoAfterExecution(perform_undo_op=do_undo):
+            # sets the resolution and the threads, the cycles settings are ignored by the other engines
+            self._configure_renderer()
+            bpy.context.scene.render.engine = self.ENGINES[self._engine]
+
+            transparent_background = self.config.get_bool("transparent_background", False)
+            bpy.context.scene.render.image_settings.color_mode = "RGBA" if transparent_background else "RGB"
+            bpy.context.scene.render.film_transparent = transparent_background
+            # Blender calls the uncompressed TGA format TARGA_RAW
+            bpy.context.scene.render.image_settings.file_format = "TARGA_RAW" if self._image_type == "TGA" else "PNG"
+            bpy.context.scene.render.image_settings.color_depth = "8"
+
+            if self._engine == "EEVEE":
+                self._configure_eevee()
+            else:
+                self._configure_workbench()
+
+            if self._use_alpha_channel:
+                self.add_alpha_channel_to_textures(blurry_edges=True)
+
+            self._render("rgb_")
+
+        self._register_output("rgb_", "colors", "." + self._image_type.lower(), "1.0.0")
+
+    def _configure_eevee(self):
+        """
+        Sets the Eevee render settings.
+        """
+        eevee = bpy.context.scene.eevee
+        eevee.taa_render_samples = self._samples
+        eevee.use_gtao = self.config.get_bool("use_ambient_occlusion", True)
+        eevee.use_soft_shadows = self.config.get_bool("use_soft_shadows", True)
+
+    def _configure_workbench(self):
+        """
+        Sets the Workbench render settings and keyframes the viewport colors of the materials.
+        """
+        # Workbench only supports a few sample counts, the next larger one is used
+        supported_samples = [5, 8, 11, 16, 32]
+        bpy.context.scene.display.render_aa = str(min([samples for samples in supported_samples
+                                                       if samples >= self._samples], default=32))
+        shading = bpy.context.scene.display.shading
+        shading.light = "STUDIO"
+        shading.color_type = "MATERIAL"
+
+        # Samplers keyframe the base color of the Principled BSDF, which Workbench ignores. The keyframes are
+        # evaluated directly, changing the frame would already trigger the handlers of the RenderFilePathOverwriter.
+        for material in bpy.data.materials:
+            if not material.use_nodes:
+                continue
+            principled_bsdfs = Utility.get_nodes_with_type(material.node_tree.nodes, "BsdfPrincipled")
+            if not principled_bsdfs:
+                continue
+
+            base_color = principled_bsdfs[0].inputs["Base Color"]
+            material.diffuse_color = base_color.default_value
+
+            animation_data = material.node_tree.animation_data
+            if animation_data is None or animation_data.action is None:
+                continue
+            data_path = base_color.path_from_id("default_value")
+            fcurves = [animation_data.action.fcurves.find(data_path, index=i) for i in range(4)]
+            if not any(fcurves):
+                continue
+
+            for frame in range(bpy.context.scene.frame_start, bpy.context.scene.frame_end):
+                material.diffuse_color = [fcurve.evaluate(frame) if fcurve is not None else value
+                                          for fcurve, value in zip(fcurves, base_color.default_value)]
+                material.keyframe_insert(data_path="diffuse_color", frame=frame)
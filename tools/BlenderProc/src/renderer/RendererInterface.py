@@ -121,7 +121,8 @@ class RendererInterface(Module):
           - bool
         * - cpu_threads
           - Set number of cpu cores used for rendering (1 thread is always used for coordination if more than one
-            cpu thread means GPU-only rendering). Default: 1
+            cpu thread means GPU-only rendering). Overwritten by the environment variable
+            "BLENDER_PROC_CPU_THREADS" if it is set. Default: 1
           - int
         * - render_normals
           - If true, the normals are also rendered. Default: False
@@ -193,6 +194,9 @@ def _configure_renderer(self, default_samples=256, use_denoiser=False, default_d
         # Set number of cpu cores used for rendering (1 thread is always used for coordination => 1
         # cpu thread means GPU-only rendering)
         number_of_threads = self.config.get_int("cpu_threads", 1)
+        # The renderer decides how many threads a process rendering on the CPU gets
+        if os.getenv("BLENDER_PROC_CPU_THREADS"):
+            number_of_threads = int(os.getenv("BLENDER_PROC_CPU_THREADS"))
         # If set to 0, use number of cores (default)
         if number_of_threads > 0:
             bpy.context.scene.render.threads_mode = "FIXED"
@@ -8,7 +8,8 @@ class RgbRenderer(RendererInterface):
     """
     Renders rgb images for each registered keypoint.
 
-    Images are stored as PNG-files or JPEG-files with 8bit color depth.
+    Images are stored as PNG-files, JPEG-files or uncompressed TGA-files with 8bit color depth. TGA-files are larger,
+    but skip the compression, which takes up a large part of the time of small images.
 
     .. list-table:: 
         :widths: 25 100 10
@@ -22,7 +23,7 @@ class RgbRenderer(RendererInterface):
             False.
           - bool
         * - image_type
-          - Image type of saved rendered images, Default: 'PNG'. Available: ['PNG','JPEG']
+          - Image type of saved rendered images, Default: 'PNG'. Available: ['PNG','JPEG','TGA']
           - str
         * - transparent_background
           - Whether to render the background as transparent or not, Default: False.
@@ -98,7 +99,9 @@ def run(self):
             bpy.context.scene.render.image_settings.color_mode = "RGBA" if self.config.get_bool("transparent_background", False) else "RGB"
             #set the background as transparent if transparent_background is true in yaml
             bpy.context.scene.render.film_transparent = self.config.get_bool("transparent_background", False)
-            bpy.context.scene.render.image_settings.file_format = self._image_type
+            # Blender calls the uncompressed TGA format TARGA_RAW
+            bpy.context.scene.render.image_settings.file_format = "TARGA_RAW" if self._image_type == "TGA" \
+                else self._image_type
             bpy.context.scene.render.image_settings.color_depth = "8"
 
             # only influences jpg quality
@@ -134,5 +137,7 @@ def run(self):
             self._register_output("rgb_", "colors", ".png", "1.0.0")
         elif self._image_type == 'JPEG':
             self._register_output("rgb_", "colors", ".jpg", "1.0.0")
+        elif self._image_type == 'TGA':
+            self._register_output("rgb_", "colors", ".tga", "1.0.0")
         else:
             raise Exception("Unknown Image Type " + self._image_type)
@@ -0,0 +1,86 @@
+# blender --background --python run_worker.py  -- <config> <temp_dir> [<args>]
+#
+# Reads the chunks to render from stdin, one json object per line with the "args" of the chunk and the "seed" of the
+# random generators, until an empty line is read or stdin is closed. The <args> on the command line are only used to
+# parse the config before the first chunk. Progress is reported as telemetry events: "frame" for every written frame,
+# "timing" for every finished block of the pipeline, "error" if the pipeline failed and "chunk" once a chunk is
+# finished.
+import json
+import random
+import sys
+import os
+import time
+import traceback
+from sys import platform
+
+
+# Make sure the current script directory is in PATH, so we can load other python modules
+dir = "."  # From CLI
+if not dir in sys.path:
+    sys.path.append(dir)
+
+# Add path to custom packages inside the blender main directory
+if platform == "linux" or platform == "linux2":
+    packages_path = os.path.abspath(os.path.join(os.path.dirname(sys.executable), "..", "..", "..", "custom-python-packages"))
+elif platform == "darwin":
+    packages_path = os.path.abspath(os.path.join(os.path.dirname(sys.executable), "..", "..", "..", "..", "Resources", "custom-python-packages"))
+elif platform == "win32":
+    packages_path = os.path.abspath(os.path.join(os.path.dirname(sys.executable), "..", "..", "..", "custom-python-packages"))
+else:
+    raise Exception("This system is not supported yet: {}".format(platform))
+sys.path.append(packages_path)
+
+import bpy
+import numpy as np
+
+from src.main.PersistentPipeline import PersistentPipeline
+from src.utility.Telemetry import Telemetry
+
+# Read args
+argv = sys.argv
+argv = argv[argv.index("--") + 1:]
+working_dir = os.path.dirname(os.path.abspath(__file__))
+
+config_path = argv[0]
+temp_dir = argv[1]
+
+# times at which the current chunk was started and its frames were written
+frames = []
+
+
+@bpy.app.handlers.persistent
+def handler_record_frame(scene, *args):
+    now = time.time()
+    Telemetry.emit("frame", frame=scene.frame_current, seconds=now - (frames[-1] if frames else started))
+    frames.append(now)
+
+
+bpy.app.handlers.render_write.append(handler_record_frame)
+
+Telemetry.enabled = True
+pipeline = PersistentPipeline(config_path, working_dir, temp_dir)
+line = sys.stdin.readline()
+while line.strip():
+    chunk = json.loads(line)
+    frames.clear()
+    started = time.time()
+
+    # every attempt of a chunk gets its own seed, so a failing chunk does not fail the same way again
+    if chunk["seed"] is not None:
+        random.seed(chunk["seed"])
+        np.random.seed(chunk["seed"])
+
+    try:
+        pipeline.run(chunk["args"])
+    except Exception:
+        traceback.print_exc()
+        Telemetry.emit("error", error=traceback.format_exc())
+        Telemetry.emit("chunk", status="failed", frames=len(frames), started=started,
+                       first_frame=frames[0] if frames else None, ended=time.time())
+        # the scene might be left in any state, so this process can not render further chunks
+        sys.exit(1)
+
+    Telemetry.emit("chunk", status="done", frames=len(frames), started=started,
+                   first_frame=frames[0] if frames else None, ended=time.time())
+
+    line = sys.stdin.readline()
@@ -0,0 +1,29 @@
+import json
+import time
+
+
+class Telemetry:
+    """
+    Emits structured events on stdout, so a parent process can follow the progress of the pipeline.
+
+    Each event is printed as a single line, starting with MARKER followed by a json object. The object contains the
+    type of the event under "event", the time it was emitted under "time" and all other given values. Events are
+    only emitted once the telemetry is enabled, for example by run_worker.py.
+    """
+
+    MARKER = "BLENDER_PROC_EVENT "
+
+    enabled = False
+
+    @staticmethod
+    def emit(event, **values):
+        """ Prints an event if the telemetry is enabled.
+
+        :param event: The type of the event, for example "frame" or "timing".
+        :param values: Further values describing the event, they must be serializable as json.
+        """
+        if not Telemetry.enabled:
+            return
+
+        values.update(event=event, time=time.time())
+        print(Telemetry.MARKER + json.dumps(values), flush=True)
@@ -6,6 +6,7 @@
 import inspect
 import importlib
 from src.utility.Config import Config
+from src.utility.Telemetry import Telemetry
 from mathutils import Matrix, Vector
 import numpy as np
 
@@ -263,7 +264,9 @@ def __enter__(self):
             self.start = time.time()
 
         def __exit__(self, type, value, traceback):
-            print("#### Finished - " + self.block_name + " (took " + ("%.3f" % (time.time() - self.start)) + " seconds) ####")
+            duration = time.time() - self.start
+            print("#### Finished - " + self.block_name + " (took " + ("%.3f" % duration) + " seconds) ####")
+            Telemetry.emit("timing", block=self.block_name, seconds=duration)
 
     class UndoAfterExecution:
         """ Reverts all changes done to the blender project inside this block.